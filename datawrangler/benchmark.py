@@ -0,0 +1,406 @@
+#!/usr/bin/python
+"""
+Benchmarks the data wrangler against synthetic sources served from a local HTTP server, with a stub of the
+GeoServer importer REST API, so that changes to downloading, parsing, conversion, loading and uploading can
+be compared in numbers. Run it from this folder like example.py:
+
+    python benchmark.py --scales 1000,100000 --mongo localhost:27017 --output results.json
+
+--mongomock runs against an in-process stand-in for mongod instead (pip install mongomock). Shapefiles need
+the GDAL python bindings, xls workbooks need xlwt and xlsx workbooks need openpyxl, sources whose writer is
+missing are skipped.
+"""
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import random
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import threading
+import urlparse
+import SimpleHTTPServer
+import BaseHTTPServer
+import SocketServer
+from zipfile import ZipFile, ZIP_DEFLATED
+import pymongo
+import database
+from geoserver import GeoServer
+from geoserver_stub import serve_importer
+
+COLUMNS = ['id', 'ident', 'type', 'name', 'latitude_deg', 'longitude_deg', 'elevation_ft', 'iso_country',
+           'municipality', 'last_updated']
+
+
+def synthetic_rows(count, seed=0):
+    """
+    :return: A generator of count airport like rows with coordinates, numbers, dates and text.
+    """
+    rand = random.Random(seed)
+    types = ['small_airport', 'heliport', 'medium_airport', 'large_airport', 'closed']
+    countries = ['US', 'CA', 'BR', 'DE', 'AU', 'JP', 'NG', 'IN']
+    start = datetime.date(2000, 1, 1)
+    for row_id in xrange(1, count + 1):
+        yield {'id': row_id,
+               'ident': 'X{:06d}'.format(row_id),
+               'type': rand.choice(types),
+               'name': 'Synthetic Field {}, "{}"'.format(row_id, rand.choice(types).replace('_', ' ')),
+               'latitude_deg': round(rand.uniform(-89.9, 89.9), 6),
+               'longitude_deg': round(rand.uniform(-179.9, 179.9), 6),
+               'elevation_ft': rand.randint(-100, 12000),
+               'iso_country': rand.choice(countries),
+               'municipality': 'Town {}'.format(rand.randint(1, 5000)),
+               'last_updated': (start + datetime.timedelta(days=rand.randint(0, 6000))).isoformat()}
+
+
+def write_delimited(path, rows, delimiter=','):
+    with open(path, 'wb') as data_file:
+        writer = csv.DictWriter(data_file, COLUMNS, delimiter=delimiter)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return path
+
+
+def write_gzipped(path, rows):
+    with gzip.open(path, 'wb') as data_file:
+        writer = csv.DictWriter(data_file, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return path
+
+
+def write_feature_collection(path, rows):
+    with open(path, 'w') as data_file:
+        data_file.write('{"type": "FeatureCollection", "features": [')
+        separator = '\n'
+        for row in rows:
+            feature = {'type': 'Feature',
+                       'geometry': {'type': 'Point', 'coordinates': [row['longitude_deg'], row['latitude_deg']]},
+                       'properties': row}
+            data_file.write(separator)
+            json.dump(feature, data_file)
+            separator = ',\n'
+        data_file.write('\n]}')
+    return path
+
+
+def write_geonames(path, rows):
+    txt_name = os.path.splitext(os.path.basename(path))[0] + '.txt'
+    txt_path = write_delimited(os.path.join(os.path.dirname(path), txt_name), rows, delimiter='\t')
+    with ZipFile(path, 'w', ZIP_DEFLATED) as archive:
+        archive.write(txt_path, txt_name)
+    os.remove(txt_path)
+    return path
+
+
+def write_shapefile(path, rows):
+    try:
+        from osgeo import ogr, osr
+    except ImportError:
+        return None
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if driver is None:
+        return None
+    folder = tempfile.mkdtemp()
+    name = os.path.splitext(os.path.basename(path))[0]
+    data_source = driver.CreateDataSource(os.path.join(folder, name + '.shp'))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = data_source.CreateLayer(name, srs, ogr.wkbPoint)
+    for column in ['ident', 'type', 'name', 'iso_country']:
+        layer.CreateField(ogr.FieldDefn(column, ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('elevation', ogr.OFTInteger))
+    for row in rows:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        for column in ['ident', 'type', 'name', 'iso_country']:
+            feature.SetField(column, row[column])
+        feature.SetField('elevation', row['elevation_ft'])
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint(row['longitude_deg'], row['latitude_deg'])
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+    data_source = None
+    with ZipFile(path, 'w', ZIP_DEFLATED) as archive:
+        for file_name in os.listdir(folder):
+            archive.write(os.path.join(folder, file_name), file_name)
+    shutil.rmtree(folder)
+    return path
+
+
+def write_xlsx(path, rows):
+    openpyxl = database.lazy_import('openpyxl', required=False)
+    if not openpyxl:
+        return None
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet('airports')
+    sheet.append(COLUMNS)
+    for row in rows:
+        sheet.append([row[column] for column in COLUMNS])
+    book.save(path)
+    return path
+
+
+def write_xls(path, rows):
+    try:
+        import xlwt
+    except ImportError:
+        return None
+    book = xlwt.Workbook()
+    sheet = book.add_sheet('airports')
+    for column_num, column in enumerate(COLUMNS):
+        sheet.write(0, column_num, column)
+    # xls sheets hold at most 65536 rows.
+    for row_num, row in enumerate(rows, 1):
+        if row_num >= 65536:
+            break
+        for column_num, column in enumerate(COLUMNS):
+            sheet.write(row_num, column_num, row[column])
+    book.save(path)
+    return path
+
+
+# data_format, file extension and writer of each synthetic source.
+SOURCE_TYPES = [('csv', 'csv', write_delimited),
+                ('tsv', 'tsv', lambda path, rows: write_delimited(path, rows, delimiter='\t')),
+                ('gzipped_csv', 'gz', write_gzipped),
+                ('json', 'json', write_feature_collection),
+                ('esri shapefile', 'zip', write_shapefile),
+                ('zipped_geonames', 'zip', write_geonames),
+                ('xlsx', 'xlsx', write_xlsx),
+                ('xls', 'xls', write_xls)]
+
+
+def generate_sources(folder, scale):
+    """
+    :return: A list of (import_name, data_format, path) for each source that could be written at this scale.
+    """
+    sources = []
+    for data_format, extension, writer in SOURCE_TYPES:
+        import_name = 'bench_{}_{}'.format(data_format.replace(' ', '_'), scale)
+        path = os.path.join(folder, import_name + '.' + extension)
+        if writer(path, synthetic_rows(scale)):
+            sources.append((import_name, data_format, path))
+        else:
+            print "Skipping " + data_format + " sources, the library that writes them isn't installed."
+    return sources
+
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve_folder(folder):
+    """
+    :return: A server for the files in folder on a free local port, running in a thread.
+    """
+    class FolderHandler(QuietHandler):
+        def translate_path(self, path):
+            return os.path.join(folder, os.path.basename(urlparse.urlparse(path).path))
+    server = ThreadedServer(('127.0.0.1', 0), FolderHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def peak_rss():
+    # ru_maxrss is the peak of the whole process, in kilobytes on linux and bytes on macOS.
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 if sys.platform == 'darwin' else usage
+
+
+def current_rss():
+    """
+    :return: The resident memory of the process in kilobytes, or None where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def measure(scenario, scale, function, *args, **kwargs):
+    rss_before = current_rss()
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, {'scenario': scenario, 'scale': scale, 'seconds': time.time() - start,
+                    'rss_before_kb': rss_before, 'rss_after_kb': current_rss()}
+
+
+def run_stats(db, kind):
+    """
+    :return: The stage seconds and counts of each source in the last run of this kind.
+    """
+    runs = list(db.database.run_history.find({'kind': kind}).sort('date', pymongo.DESCENDING).limit(1))
+    if not runs:
+        return {}
+    return dict((source['import_name'], source) for source in runs[0].get('sources', []))
+
+
+def source_results(scenario, scale, seconds, stats):
+    results = []
+    for import_name in sorted(stats):
+        stages = stats[import_name].get('stages', {})
+        counts = stats[import_name].get('counts', {})
+        stage_seconds = sum(totals.get('seconds', 0) for totals in stages.values())
+        results.append({'scenario': scenario,
+                        'scale': scale,
+                        'source': import_name,
+                        'rows': counts.get('rows', 0),
+                        'bytes': counts.get('bytes', 0),
+                        'seconds': stage_seconds,
+                        'rows_per_second': counts.get('rows', 0) / stage_seconds if stage_seconds else 0,
+                        'stages': dict((stage, round(totals.get('seconds', 0), 4)) for stage, totals in stages.items()),
+                        'run_seconds': seconds})
+    return results
+
+
+def benchmark_scale(db, scale, folder, http_port, geoserver_port):
+    results = []
+    sources = generate_sources(folder, scale)
+    names = [import_name for import_name, data_format, path in sources]
+    for import_name in names:
+        db.database.drop_collection(import_name)
+    db.database.data_sources.delete_many({'import_name': {'$in': names}})
+
+    # direct loads of the local files.
+    for import_name, data_format, path in sources:
+        result = measure('import_file', scale, db.import_file, path, data_format, collection=import_name)[1]
+        run = db.instrumentation.finish(db.database, sources=[import_name], kind='benchmark')
+        results.append(result)
+        results += source_results('import_file', scale, result['seconds'],
+                                  dict((source['import_name'], source) for source in run['sources']))
+
+    # full refreshes, downloading each source from the local server.
+    for import_name, data_format, path in sources:
+        db.database.drop_collection(import_name)
+        db.database.data_sources.update_one({'import_name': import_name},
+                                            {'$set': {'import_name': import_name,
+                                                      'data_url': 'http://127.0.0.1:{}/{}'.format(
+                                                          http_port, os.path.basename(path)),
+                                                      'data_format': data_format,
+                                                      'refresh_rate': 0,
+                                                      'data_date': None},
+                                             '$unset': {'import_hash': '', 'etag': '', 'last_modified': ''}},
+                                            upsert=True)
+    timings, result = measure('update_data', scale, db.update_data)
+    results.append(result)
+    results += source_results('update_data', scale, result['seconds'],
+                              dict((name, stats) for name, stats in run_stats(db, 'refresh').items() if name in names))
+
+    # OGR conversions of the spatial sources.
+    for import_name, data_format, path in sources:
+        ogr_format = db.ogr_formats.get(db.compressed_formats.get(data_format, data_format))
+        if not ogr_format:
+            continue
+        for source_file in db.archive_files(path, data_format):
+            json_path, result = measure('convert_to_json', scale, db.convert_to_json, source_file.ogr_path(),
+                                        ogr_format)
+            result['source'] = import_name
+            result['bytes'] = os.path.getsize(json_path) if os.path.isfile(json_path) else 0
+            results.append(result)
+            for extension, driver_name in sorted(database.OGR_CONVERSION_DRIVERS.items()):
+                output_path = source_file.name + '.' + extension
+                copied, result = measure('copy_ogr_layers', scale, database.copy_ogr_layers,
+                                         source_file.ogr_path(), ogr_format, output_path, driver_name)
+                if not copied:
+                    continue
+                result['source'] = import_name
+                result['format'] = extension
+                result['bytes'] = os.path.getsize(output_path)
+                results.append(result)
+
+    # uploads of what the refresh produced to the stub GeoServer.
+    file_names = []
+    for source in db.database.data_sources.find({'import_name': {'$in': names}}):
+        file_names += source.get('local_file_path') or []
+    if file_names:
+        upload_results, result = measure('upload_to_geoserver', scale, db.upload_to_geoserver,
+                                         host='127.0.0.1', port=geoserver_port, workspace='bench',
+                                         targetStore='bench', source=file_names, username='admin',
+                                         password='geoserver')
+        result['files'] = len(file_names)
+        result['tasks_complete'] = len([task for task in upload_results if task.get('state') == 'COMPLETE'])
+        results.append(result)
+    return results
+
+
+def print_results(results, peak_rss_kb):
+    print
+    print "{:<20} {:>8} {:<34} {:>10} {:>10} {:>12} {:>12}".format('scenario', 'scale', 'source', 'rows',
+                                                                  'seconds', 'rows/s', 'RSS MB')
+    for result in results:
+        rss = '-'
+        if result.get('rss_before_kb') is not None and result.get('rss_after_kb') is not None:
+            rss = "{}->{}".format(result['rss_before_kb'] / 1024, result['rss_after_kb'] / 1024)
+        print "{:<20} {:>8} {:<34} {:>10} {:>10.3f} {:>12.0f} {:>12}".format(
+            result['scenario'], result['scale'], result.get('source', '-'), result.get('rows', '-'),
+            result['seconds'], result.get('rows_per_second', 0), rss)
+        if result.get('stages'):
+            print " " * 30 + ", ".join("{} {:.3f}s".format(stage, seconds)
+                                       for stage, seconds in sorted(result['stages'].items()))
+    print
+    print "Peak memory of the benchmark: " + str(peak_rss_kb / 1024) + " MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the data wrangler with synthetic sources.")
+    parser.add_argument('--scales', default='1000,10000', help="Comma separated numbers of rows per source.")
+    parser.add_argument('--mongo', default='127.0.0.1:27017', help="The host:port of the mongod to load into.")
+    parser.add_argument('--mongomock', action='store_true', help="Use an in-process stand-in instead of mongod.")
+    parser.add_argument('--database', default='benchmark', help="The database to load into, it is dropped first.")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--output', help="A file to write the results to as json.")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        import mongomock
+        pymongo.MongoClient = mongomock.MongoClient
+    host, port = args.mongo.split(':')
+    pymongo.MongoClient(host, int(port)).drop_database(args.database)
+
+    folder = tempfile.mkdtemp(prefix='dw-benchmark-')
+    http_server = serve_folder(folder)
+    geoserver_server = serve_importer()
+    geoserver_port = geoserver_server.server_address[1]
+    try:
+        os.mkdir(os.path.join(folder, 'DataSources'))
+        db = database.DB(host=host, port=int(port), database=args.database,
+                         temp_dir=os.path.join(folder, 'DataSources'), workers=args.workers,
+                         streaming=args.streaming, cache_size=0)
+        # the stub completes imports quickly so the client is made to poll it just as quickly.
+        db.geoserver_clients[('127.0.0.1', str(geoserver_port), 'bench', 'bench', False)] = GeoServer(
+            port=geoserver_port, workspace='bench', store='bench', username='admin', password='geoserver',
+            workers=max(args.workers, 2), poll_interval=0.05)
+        db.setup()
+        results = []
+        for scale in [int(scale) for scale in args.scales.split(',')]:
+            results += benchmark_scale(db, scale, folder, http_server.server_address[1], geoserver_port)
+        peak_rss_kb = peak_rss()
+        print_results(results, peak_rss_kb)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump({'results': results, 'peak_rss_kb': peak_rss_kb}, output_file, indent=2, sort_keys=True)
+    finally:
+        http_server.shutdown()
+        geoserver_server.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
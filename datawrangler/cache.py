@@ -0,0 +1,90 @@
+import os
+import shutil
+
+
+class ArtifactCache:
+    """
+    Keeps downloads in folders named by the SHA-256 of their content, so a payload is only stored once however
+    many sources or refreshes return it. Everything extracted or converted from a download is written inside
+    its folder and is reused for as long as the content is unchanged. Once the folders take more than max_size
+    bytes the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_size=10737418240):
+        self.directory = directory
+        self.max_size = max_size
+
+    def entry(self, content_hash):
+        return os.path.join(self.directory, content_hash)
+
+    def add(self, file_path, content_hash, file_name):
+        """
+        :param file_path: A finished download, it is moved into the cache.
+        :param content_hash: The SHA-256 of the file.
+        :param file_name: The name to keep the file under, its extension tells how it is read.
+        :return: The path of the cached file.
+        """
+        folder = self.entry(content_hash)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        cached_path = os.path.join(folder, file_name)
+        if os.path.isfile(cached_path):
+            os.remove(file_path)
+        else:
+            # the same content downloaded under another name is linked rather than stored again.
+            copies = [name for name in os.listdir(folder) if os.path.isfile(os.path.join(folder, name))]
+            if copies and hasattr(os, 'link'):
+                os.link(os.path.join(folder, copies[0]), cached_path)
+                os.remove(file_path)
+            else:
+                shutil.move(file_path, cached_path)
+        self.touch(content_hash)
+        return cached_path
+
+    def touch(self, content_hash):
+        os.utime(self.entry(content_hash), None)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used folders until the cache fits in max_size.
+        :param keep: Hashes that are never removed, like the current content of each source.
+        :return: The hashes that were removed.
+        """
+        keep = set(keep or [])
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        total = 0
+        for content_hash in os.listdir(self.directory):
+            folder = self.entry(content_hash)
+            if not os.path.isdir(folder):
+                continue
+            size = folder_size(folder)
+            total += size
+            entries.append((os.path.getmtime(folder), content_hash, size))
+        removed = []
+        for used, content_hash, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if content_hash in keep:
+                continue
+            shutil.rmtree(self.entry(content_hash), ignore_errors=True)
+            total -= size
+            removed.append(content_hash)
+        if removed:
+            print "Evicted " + str(len(removed)) + " downloads from the cache, " + str(total) + " bytes remain."
+        return removed
+
+
+def folder_size(folder):
+    # hard linked copies only take up space once.
+    inodes = set()
+    size = 0
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            stat = os.lstat(os.path.join(root, name))
+            if stat.st_ino in inodes:
+                continue
+            inodes.add(stat.st_ino)
+            size += stat.st_size
+    return size
@@ -0,0 +1,162 @@
+import re
+import threading
+import unicodedata
+
+# columns looked in for a country when a source doesn't name its own, compared without case.
+COUNTRY_FIELDS = ['country', 'country_code', 'countrycode', 'country_name', 'iso_country', 'iso', 'iso2', 'iso3',
+                  'iso_a2', 'iso_a3', 'iso_code', 'adm0_a3', 'cntry_name', 'cntry_code', 'nation']
+# those of them that hold codes, found columns are only matched on alphabetic codes so a dialing code like +44
+# isn't read as a UN number.
+CODE_FIELDS = ['country_code', 'countrycode', 'iso_country', 'iso', 'iso2', 'iso3', 'iso_a2', 'iso_a3', 'iso_code',
+               'adm0_a3', 'cntry_code']
+CODE_PATTERN = re.compile(r'^\s*[A-Za-z]{2,3}\s*$')
+
+
+class CountryIndex:
+    """
+    Looks countries up by name, ISO 3166 alpha-2 code (ISO), alpha-3 code (UN_AB) or UN number (UN_NUM)
+    without going back to the country_codes collection. Values are compared without case, accents or
+    punctuation, and names like "Korea, Republic of" are also found as "Republic of Korea".
+    """
+
+    def __init__(self, rows, cache_size=65536):
+        """
+        :param rows: The documents of the country_codes collection.
+        :param cache_size: The number of distinct values whose country is remembered.
+        """
+        self.countries = {}
+        self.found = {}
+        self.cache_size = cache_size
+        aliases = {}
+        for row in rows:
+            country = {'name': row.get('COUNTRY'),
+                       'iso2': row.get('ISO'),
+                       'iso3': row.get('UN_AB'),
+                       'un_num': normalize(row.get('UN_NUM'))}
+            for value in [row.get('COUNTRY'), row.get('ISO'), row.get('UN_AB'), row.get('UN_NUM')]:
+                key = normalize(value)
+                if key is not None:
+                    self.countries[key] = country
+            for alias in name_aliases(row.get('COUNTRY')):
+                aliases.setdefault(alias, []).append(country)
+        # an alias shared by several countries, like "Korea", names none of them.
+        for alias, countries in aliases.iteritems():
+            if alias not in self.countries and len(countries) == 1:
+                self.countries[alias] = countries[0]
+
+    def __len__(self):
+        return len(self.countries)
+
+    def find(self, value):
+        """
+        :param value: A country name, code or number.
+        :return: A dict of the country's name, iso2, iso3 and un_num, or None if it isn't known.
+        """
+        # a column repeats a few countries over and over, so each value is only normalized once.
+        try:
+            return self.found[value]
+        except KeyError:
+            pass
+        except TypeError:
+            return None
+        key = normalize(value)
+        country = self.countries.get(key) if key is not None else None
+        if len(self.found) < self.cache_size:
+            self.found[value] = country
+        return country
+
+
+class CountryTagger:
+    """
+    Sets dw_country on documents to the country found in their country columns, so they can be queried
+    by an indexed code. One tagger is shared by the files of an import and counts the documents it tagged.
+    """
+
+    def __init__(self, index, fields=None):
+        """
+        :param index: A CountryIndex.
+        :param fields: The columns to look in, in order, or None to look in the COUNTRY_FIELDS each file has.
+        """
+        self.index = index
+        self.fields = fields
+        self.tagged = 0
+        self.lock = threading.Lock()
+
+    def tag(self, documents):
+        """
+        :param documents: Rows, or GeoJSON features whose properties hold the columns.
+        :return: A generator of the same documents.
+        """
+        fields = self.fields
+        code_fields = set()
+        tagged = 0
+        try:
+            for document in documents:
+                properties = document.get('properties') if isinstance(document.get('properties'), dict) else document
+                if fields is None:
+                    fields = country_fields(properties)
+                    code_fields = set(field for field in fields if field.strip().lower() in CODE_FIELDS)
+                    if fields:
+                        print "Tagging countries from " + ", ".join(fields) + "."
+                for field in fields:
+                    value = properties.get(field)
+                    if field in code_fields and not (isinstance(value, basestring) and CODE_PATTERN.match(value)):
+                        continue
+                    country = self.index.find(value)
+                    if country:
+                        document['dw_country'] = country
+                        tagged += 1
+                        break
+                yield document
+        finally:
+            with self.lock:
+                self.tagged += tagged
+
+
+def country_fields(document):
+    """
+    :return: The keys of a document that are in COUNTRY_FIELDS, in the order of COUNTRY_FIELDS.
+    """
+    keys = dict((key.strip().lower(), key) for key in document if isinstance(key, basestring))
+    return [keys.get(field) for field in COUNTRY_FIELDS if field in keys]
+
+
+def normalize(value):
+    """
+    :return: A lower case ascii name without punctuation, or an int for a number, or None if value is empty.
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, long)):
+        return int(value)
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else None
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    if not isinstance(value, unicode):
+        return None
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').lower()
+    value = re.sub('[^a-z0-9]+', ' ', value).strip()
+    if value.isdigit():
+        return int(value)
+    return value or None
+
+
+def name_aliases(name):
+    """
+    :return: Other ways of writing a name, "Iran, Islamic Republic of" is also "Islamic Republic of Iran"
+    and "Iran", "Holy See (Vatican City State)" is also "Holy See" and "Vatican City State".
+    """
+    if not name:
+        return []
+    aliases = []
+    match = re.match(r'^(.*?)\s*\((.*)\)\s*$', name)
+    if match:
+        aliases.append(match.group(1))
+        # "(French part)" only tells the parts of an island apart.
+        if not match.group(2).lower().endswith(' part'):
+            aliases.append(match.group(2))
+    if ',' in name:
+        base, qualifier = [part.strip() for part in name.split(',', 1)]
+        aliases += [qualifier + ' ' + base, base]
+    return [alias for alias in [normalize(alias) for alias in aliases] if alias]
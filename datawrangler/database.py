@@ -4,17 +4,43 @@ import subprocess
 import sys
 import os
 import re
-import getpass
 import requests
 import json
 import csv
-from zipfile import ZipFile
-from osgeo import ogr
-import xlrd
-import unicodecsv 
+import codecs
+import gzip
+from zipfile import ZipFile, ZIP_DEFLATED
+import importlib
+import argparse
 import datetime
 import math
-from chardet.universaldetector import UniversalDetector
+import calendar
+import heapq
+import itertools
+import random
+import hashlib
+import time
+import threading
+import Queue
+import zlib
+import urlparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from cStringIO import StringIO
+from geoserver import GeoServer
+from instrumentation import Instrumentation
+from cache import ArtifactCache
+from countries import CountryIndex, CountryTagger
+from geometries import GeometryEnricher, simplified_field
+
+COUNTRY_CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'country_codes.tsv')
+# optional dependencies are imported the first time they are needed, see lazy_import.
+LAZY_MODULES = {}
+# the export format of each file extension, see DB.export.
+EXPORT_FORMATS = {'.ndjson': 'ndjson', '.jsonl': 'ndjson', '.geojsonl': 'ndjson',
+                  '.json': 'geojson', '.geojson': 'geojson', '.csv': 'csv'}
+# conversion formats OGR writes itself, with a spatial index, and the drivers that write them.
+OGR_CONVERSION_DRIVERS = {'gpkg': 'GPKG', 'fgb': 'FlatGeobuf'}
 
 
 class DB:
@@ -26,18 +52,78 @@ class DB:
                  port=27017,
                  database='geodata',
                  temp_dir = "./DataSources",
-                 csv_file = None):
+                 csv_file = None,
+                 batch_size = 1000,
+                 workers = 1,
+                 per_host = 2,
+                 chunk_size = 1048576,
+                 conversion_format = 'geojson',
+                 encoding_sample_size = 65536,
+                 load_mode = 'upsert',
+                 tombstone = False,
+                 parse_processes = 1,
+                 parse_range_size = 16777216,
+                 infer_types = True,
+                 schema_sample_size = 1000,
+                 metrics_path = None,
+                 cache_size = 10737418240,
+                 streaming = False,
+                 stream_queue_size = 8,
+                 country_fields = None,
+                 geometry_summaries = True,
+                 simplify_tolerances = None):
         self.user = user
         self.password = password
         self.geoserver_user = None
         self.geoserver_password = None
+        self.geoserver_clients = {}
         self.host = host
         self.port = port
-        self.connection = pymongo.MongoClient()
-        self.database = self.connection["default"]
+        # nothing is sent to mongo until the first operation that needs it.
+        self.connection = pymongo.MongoClient(host, port, connect=False)
+        self.database = self.connection[database or "default"]
+        self.csv_file = csv_file
         self.temp_dir = temp_dir
-        if database:
-            self.database = self.get_database(database)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.per_host = per_host
+        self.chunk_size = chunk_size
+        #The file written for GeoServer while OGR features are imported: 'geojson', 'ndjson', 'gpkg' (GeoPackage),
+        #'fgb' (FlatGeobuf) or None.
+        self.conversion_format = conversion_format
+        #The most bytes read from a file to detect its encoding.
+        self.encoding_sample_size = encoding_sample_size
+        #'upsert' writes every document, 'incremental' only writes what changed since the last import and
+        #'swap' loads a staging collection that replaces the live one when it is complete.
+        self.load_mode = load_mode
+        #Whether an incremental import marks missing documents with dw_deleted instead of removing them.
+        self.tombstone = tombstone
+        #Large csv and tsv files are split into ranges of parse_range_size bytes parsed by this many processes.
+        self.parse_processes = parse_processes
+        self.parse_range_size = parse_range_size
+        #Columns of csv, tsv and excel rows are converted to the types inferred from the first schema_sample_size rows.
+        self.infer_types = infer_types
+        self.schema_sample_size = schema_sample_size
+        #Times the stages of each source, runs are saved to run_history and exported to metrics_path (.prom or .json).
+        self.instrumentation = Instrumentation(metrics_path)
+        #Downloads are kept by content hash in temp_dir/cache, up to cache_size bytes (0 keeps them by source name).
+        self.cache = ArtifactCache(os.path.join(temp_dir, 'cache'), cache_size) if cache_size else None
+        #Streamed sources are parsed as they download, at most stream_queue_size chunks ahead of the parser.
+        self.streaming = streaming
+        self.stream_queue_size = stream_queue_size
+        #The columns documents are tagged with a dw_country from, when a source doesn't list its own country_fields.
+        #None looks for the usual names (countries.COUNTRY_FIELDS) and an empty list turns tagging off.
+        self.country_fields = country_fields
+        self.countries = None
+        #Features get a dw_bbox and dw_centroid, and a dw_simplified_<tolerance> geometry for each of simplify_tolerances
+        #if given, like (0.001, 0.01), in the units of the coordinates (degrees for GeoJSON, 0.001 is about 100m).
+        self.geometry_summaries = geometry_summaries
+        self.simplify_tolerances = simplify_tolerances
+        #One pooled session so repeated downloads from a host reuse their connections.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(workers, 10), pool_maxsize=max(workers, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         #These mappings are to handle conversions between functions.
         #This is used to specifiy which files are found in an 'archive'
@@ -46,6 +132,9 @@ class DB:
                                    'zipped_geojson': 'geojson',
                                    'zipped_geonames': 'txt',
                                    'zipped_csv': 'csv',
+                                   'gzipped_csv': 'csv',
+                                   'gzipped_tsv': 'tsv',
+                                   'gzipped_geojson': 'geojson',
                                    'shp': 'shp'}
         #This is used to specify what the downloaded file extension should be.
         self.download_formats = {'json': 'json',
@@ -60,21 +149,10 @@ class DB:
                                  'csv': 'csv',
                                  'tsv': 'tsv',
                                  'txt': 'txt',
-                                 'zipped_geonames': 'zip'}
-        #Tells geoserver what to expect NOT all of these are actually supported like TSV.
-        self.geoserver_importer_formats = {'json': 'json',
-                                           'esri shapefile': 'shapefile',
-                                           'shp': 'zip',
-                                           'kmz': 'zip',
-                                           'kml': 'kml',
-                                           'zipped_geojson': 'geojson',
-                                           'zipped_csv': 'csv',
-                                           'xls': 'xls',
-                                           'xlsx': 'xlsx',
-                                           'csv': 'csv',
-                                           'tsv': 'tsv',
-                                           'txt': 'txt',
-                                           'zipped_geonames': 'zip'}
+                                 'zipped_geonames': 'zip',
+                                 'gzipped_csv': 'gz',
+                                 'gzipped_tsv': 'gz',
+                                 'gzipped_geojson': 'gz'}
         #Used for OGR conversions
         self.ogr_formats = {'shp':'ESRI Shapefile','kml': 'kml'}
         #If using 'mongoimport' these will be used to tell the tool what the file will be.
@@ -88,46 +166,50 @@ class DB:
                                            'tsv': 'tsv',
                                            'txt': 'tsv',
                                            'zipped_csv': 'csv',
-                                           'zipped_geonames': 'tsv'}
+                                           'zipped_geonames': 'tsv',
+                                           'gzipped_csv': 'csv',
+                                           'gzipped_tsv': 'tsv',
+                                           'gzipped_geojson': 'json'}
         self.mongoimport_supported_formats = ['csv','tsv','json']
-        if not self.database.country_codes.find_one():
-            self.import_file(os.path.abspath('./country_codes.tsv'),'tsv',collection="country_codes")
-        if csv_file:
-            self.import_file(os.path.abspath(csv_file),'csv',collection="data_sources",data_key="import_name",compare="data_date")
-        self.update_data()
+        #Formats that can be parsed front to back as they download, zip archives and workbooks need the whole file.
+        self.streaming_formats = ['json', 'csv', 'tsv', 'txt', 'gzipped_csv', 'gzipped_tsv', 'gzipped_geojson']
+        #Formats whose documents carry a GeoJSON 'geometry' field.
+        self.spatial_formats = ['json', 'esri shapefile', 'shp', 'kmz', 'kml', 'zipped_geojson', 'gzipped_geojson']
 
     def __del__(self):
         self.connection.close()
 
-    def connect(self):
-        if self.connection.HOST == self.host and self.connection.PORT == self.port:
-            return True
-        else:
-            self.connection = pymongo.MongoClient(self.host, self.port)
-            try:
-                self.connection.server_info()
-                return True
-            except pymongo.errors, message:
-                self.connection = None
-                print(message)
-                print("Failed to Connect")
-                return False
+    def setup(self):
+        """
+        Indexes data_sources and imports the country codes the first time they are needed.
+        """
+        self.ensure_key_index('data_sources', 'import_name')
+        if not self.database.country_codes.find_one():
+            self.import_file(COUNTRY_CODES,'tsv',collection="country_codes")
 
-    def get_database(self, database):
-        if not self.connect():
-            return None
-        if self.database.name == database:
-            return self.database
-        else:
-            return self.connection[database]
+    def sync_sources(self, csv_file=None):
+        """
+        :param csv_file: A csv of sources like Sources.csv, each row is upserted into data_sources on its import_name.
+        """
+        csv_file = csv_file or self.csv_file
+        self.setup()
+        self.import_file(os.path.abspath(csv_file),'csv',collection="data_sources",data_key="import_name",compare="data_date")
 
-    def import_file(self, file_paths, file_format, collection=None, data_key=None, compare=None, header=None):
+    def import_file(self, file_paths, file_format, collection=None, data_key=None, compare=None, header=None,
+                    content_hash=None, load_mode=None):
         if type(file_paths) is not list:
             file_paths = [file_paths]
 
         if not collection:
             collection = os.path.splitext(os.path.basename(file_paths[0]))[0]
 
+        if self.is_current(collection, content_hash):
+            print collection + " already holds the data of " + os.path.basename(file_paths[0]) + "."
+            return
+        if content_hash:
+            # cleared until the load finishes so a partial load is never taken as current.
+            self.database.data_sources.update_one({'import_name': collection}, {'$unset': {'import_hash': ''}})
+
         ## This was optionally if wishing to use mongoimport as opposed to importing the files with a custom routine.
         # if 'win32' in sys.platform:
         #     bin_dir = r"C:\Program Files\MongoDB\Server\3.2\bin"
@@ -137,83 +219,494 @@ class DB:
         #     print("Current operating system is not supported")
         #     return False
 
-        # shapefiles are expected to be a zipped file
-        if file_format.lower() in self.compressed_formats:
-            new_file_paths = []
-            for file_path in file_paths:
-                new_file_paths += self.convert_compressed_format(file_path, file_format)
-            file_paths = new_file_paths
-        # excel files are converted to csv
-        elif 'xls' in file_format.lower():
-            new_file_paths = []
-            for file_path in file_paths:
-                new_file_paths += self.convert_from_excel(file_path)
-            file_paths = new_file_paths
+        # shapefiles are expected to be a zipped file, the matching members are read in place.
+        with self.instrumentation.stage(collection, 'extract'):
+            # streams are parsed as they download, see DB.stream_source.
+            if isinstance(file_paths[0], StreamSource):
+                source_files = file_paths
+            elif file_format.lower() in self.compressed_formats:
+                source_files = []
+                for file_path in file_paths:
+                    source_files += self.archive_files(file_path, file_format)
+            # excel sheets are read row by row, each sheet is a separate source file.
+            elif 'xls' in file_format.lower():
+                source_files = []
+                for file_path in file_paths:
+                    source_files += self.excel_files(file_path)
+            else:
+                source_files = [SourceFile(file_path) for file_path in file_paths]
 
         import_file_format = self.mongoimport_mapped_formats.get(file_format.lower())
+        ogr_format = self.ogr_formats.get(self.compressed_formats.get(file_format.lower(), file_format.lower()))
 
-        for file_path in file_paths:
-            doc_count = 0
-            print "Importing " + file_path + " into " + collection + "..."
-            if os.path.getsize(file_path) > 16000000:
-                    print "The json is too large to import into MongoDB."
-                    continue
-            with open(file_path, 'r') as data_file:
-                if import_file_format.lower() == 'json':
-                    enc_det = detect_encoding(data_file)
-                    if enc_det.get('encoding'):
-                        print "Encoding detected: " + enc_det.get('encoding')
-                        json_data = json.load(data_file, encoding=enc_det.get('encoding'))
-                    else:
-                        json_data = json.load(data_file)
-                    if type(json_data) != 'list':
-                        json_data = [json_data]
-                    for json_obj in json_data:
-                        self.submit_document(json_obj,collection, data_key=data_key,compare=compare)
-                        doc_count += 1
-                elif import_file_format.lower() in ['csv','tsv']:
-                    try:
-                        header = int(header)
-                    except:
-                        header = 0
-                    if header != 0:
-                        data_file.seek(0)
-                        read_line_number(data_file,(header-1))
-                    try:
-                        header_data = data_file.readline()
-                        dialect = csv.Sniffer().sniff(header_data, ['\t',',',';'])
-                    except:
-                        print "Unable to determine the proper delimeter."
-                        print "Please check the file " + file_path + " and try again."
-                        continue
-                    csv_data = csv.reader([header_data], dialect)
-                    header_row = next(csv_data)
-                    print "Header detected as: " + str(header_row)
-                    dict_reader = csv.DictReader(data_file,header_row)
-                    for row in dict_reader:
-                        if self.submit_document(row, collection, data_key=data_key):
-                            doc_count += 1
-            self.database.data_sources.update_one({'import_name':collection},{"$set":{"local_file_path":file_paths}})
-            print("Imported " + str(doc_count) + " documents into " + collection + ".")
-
-            ## This was optionally if wishing to use mongoimport as opposed
-            ## to importing the files with a custom routine.
-            # print file_path
-            # execute = [os.path.join(bin_dir,"mongoimport"),
-            #            "--host", self.host,
-            #            "--port", str(self.port),
-            #            "-d", self.database.name,
-            #            "-c", collection,
-            #            "--type", import_file_format,
-            #            "--file", file_path]
-            # if file_format.lower() != "json":
-            #     execute.append("--headerline")
-            # if data_key:
-            #     execute += ["--upsertFields",data_key]
-            # if os.path.isfile(os.path.join(bin_dir,"mongoimport")):
-            #     subprocess.call(execute)
-            # else:
-            #     print("Mongo tools not found")
+        tagger = self.country_tagger(collection)
+        enricher = None
+        if self.geometry_summaries and (ogr_format or import_file_format == 'json'):
+            ogr = lazy_import('osgeo.ogr', required=False)
+            if ogr is None:
+                print "GDAL isn't installed, only bounding boxes are computed."
+            enricher = GeometryEnricher(self.simplify_tolerances, ogr=ogr)
+
+        load_mode = load_mode or self.load_mode
+        # a swap loads a staging collection so readers never see a partial load and the previous data
+        # survives a failed one.
+        target = collection
+        if load_mode == 'swap':
+            target = collection + '_staging'
+            self.database.drop_collection(target)
+
+        # upserts look documents up by data_key so that index has to exist before loading,
+        # any other index is only built after the load.
+        diff_writer = None
+        if load_mode == 'incremental':
+            # data_key may name several comma separated fields, without one documents are keyed by their hash.
+            key_fields = [field.strip() for field in data_key.split(',')] if data_key else []
+            self.ensure_key_index(collection, 'dw_key')
+            diff_writer = DiffWriter(self.database[collection],
+                                     key_fields=key_fields,
+                                     batch_size=self.batch_size,
+                                     tombstone=self.tombstone)
+        elif data_key:
+            self.ensure_key_index(target, data_key)
+
+        def import_one(source_file):
+            encoding = None
+            if import_file_format == 'json' and isinstance(source_file, StreamSource):
+                with self.instrumentation.stage(collection, 'encoding'):
+                    encoding = source_file.detect_encoding(self.encoding_sample_size)
+            elif import_file_format == 'json' and not ogr_format:
+                with self.instrumentation.stage(collection, 'encoding'):
+                    encoding = self.detect_file_encoding(source_file, collection, content_hash=content_hash)
+            return self.import_source_file(source_file, target, import_file_format,
+                                           ogr_format=ogr_format, data_key=data_key, header=header,
+                                           encoding=encoding, writer=diff_writer, import_name=collection,
+                                           tagger=tagger, enricher=enricher, fail_on_errors=target != collection)
+
+        # separate members and sheets are independent so they can be loaded at the same time.
+        try:
+            if self.workers > 1 and len(source_files) > 1:
+                pool = ThreadPool(min(self.workers, len(source_files)))
+                results = pool.map(import_one, source_files, chunksize=1)
+                pool.close()
+                pool.join()
+            else:
+                results = [import_one(source_file) for source_file in source_files]
+        except:
+            if target != collection:
+                print "The load of " + collection + " failed, its previous data was left in place."
+                self.database.drop_collection(target)
+            raise
+        output_paths = []
+        for output_path in results:
+            if output_path and output_path not in output_paths:
+                output_paths += [output_path]
+        import_fields = {"local_file_path":output_paths}
+        if enricher and enricher.extent:
+            import_fields['extent'] = enricher.extent
+        if diff_writer:
+            with self.instrumentation.stage(collection, 'write'):
+                diff_writer.finish()
+            self.instrumentation.count(collection, 'documents', diff_writer.added + diff_writer.changed)
+            print("{} documents added, {} changed, {} unchanged and {} removed in {}.".format(
+                diff_writer.added, diff_writer.changed, diff_writer.unchanged, diff_writer.removed, collection))
+            import_fields['last_import'] = {'date': int('{:%Y%m%d%H%M%S}'.format(datetime.datetime.now())),
+                                            'added': diff_writer.added,
+                                            'changed': diff_writer.changed,
+                                            'unchanged': diff_writer.unchanged,
+                                            'removed': diff_writer.removed}
+        # a diff whose writes failed is compared again on the next refresh even if the content is unchanged.
+        if content_hash and not (diff_writer and diff_writer.failed()):
+            import_fields['import_hash'] = content_hash
+        self.database.data_sources.update_one({'import_name':collection},{"$set":import_fields})
+
+        # the spatial index is built once after the load rather than maintained on every write.
+        with self.instrumentation.stage(collection, 'index'):
+            point_fields = set()
+            imported = self.database.data_sources.find_one({'import_name': collection}, {'schemas': 1})
+            for schema in (imported or {}).get('schemas') or []:
+                if schema.get('point'):
+                    point_fields.add(schema.get('point_field') or 'geometry')
+            if file_format.lower() in self.spatial_formats:
+                point_fields.add('geometry')
+            for field in sorted(point_fields):
+                self.ensure_spatial_index(target, field)
+            if tagger and tagger.tagged:
+                self.ensure_country_index(target)
+            if enricher and enricher.count:
+                self.ensure_summary_indexes(target)
+            if target != collection:
+                self.swap_collection(target, collection)
+
+    def is_current(self, collection, content_hash):
+        """
+        :param collection: The import_name of a source.
+        :param content_hash: The hash of the file about to be imported.
+        :return: True if that content was already loaded into the collection.
+        """
+        if not content_hash:
+            return False
+        return (self.database.data_sources.find_one({'import_name': collection, 'import_hash': content_hash}) is not None
+                and self.database[collection].find_one() is not None)
+
+    def swap_collection(self, staging, collection):
+        """
+        Builds the live collection's indexes on the staging collection then renames it over the live one.
+        :param staging: The name of the fully loaded staging collection.
+        :param collection: The name of the live collection to replace.
+        :return: True if the live collection was replaced.
+        """
+        if not self.database[staging].find_one():
+            print "Nothing was loaded into " + staging + " so " + collection + " was left as it was."
+            self.database.drop_collection(staging)
+            return False
+        for name, index in self.database[collection].index_information().iteritems():
+            if name == '_id_':
+                continue
+            options = dict((option, value) for option, value in index.iteritems() if option not in ['key', 'v', 'ns'])
+            try:
+                self.database[staging].create_index(index.get('key'), name=name, **options)
+            except pymongo.errors.OperationFailure as e:
+                print "Unable to copy the index " + name + " to " + staging + ": " + str(e)
+        self.database[staging].rename(collection, dropTarget=True)
+        print "Replaced " + collection + " with " + staging + "."
+        return True
+
+    def import_source_file(self, source_file, collection, import_file_format, ogr_format=None, data_key=None, header=None,
+                           encoding=None, writer=None, import_name=None, tagger=None, enricher=None,
+                           fail_on_errors=False):
+        """
+        :param source_file: The SourceFile to import.
+        :param collection: The name of the collection to import into.
+        :param import_file_format: One of the mongoimport_supported_formats.
+        :param ogr_format: The OGR driver to read the file with, if it is a spatial format.
+        :param data_key: The field to upsert documents on.
+        :param header: The row of a csv, tsv or excel sheet that holds the column names.
+        :param encoding: The encoding of a json file, it is detected if not given.
+        :param writer: A DiffWriter shared by all the files of an incremental import, the caller finishes it.
+        :param import_name: The import_name of the source, its data_sources record caches the inferred schema.
+        :param tagger: A CountryTagger shared by all the files of the import.
+        :param enricher: A GeometryEnricher shared by all the files of the import.
+        :param fail_on_errors: Whether documents mongo refused, other than duplicates, fail the import, as they
+        should when a staging collection is about to replace the live one.
+        :return: The path of the file GeoServer should use for this source file.
+        """
+        import_name = import_name or collection
+        shared_writer = writer is not None
+        if not shared_writer:
+            writer = BulkWriter(self.database[collection], data_key=data_key, batch_size=self.batch_size)
+        print "Importing " + source_file.name + " into " + collection + "..."
+        if ogr_format:
+            # features go straight from OGR to mongo, a file is only written alongside for GeoServer.
+            output_path = source_file.path
+            converted = False
+            if self.conversion_format:
+                output_path = self.conversion_path(source_file.name)
+                # a conversion is only renamed into place once it is complete, so one newer than its source is reused.
+                if newer(output_path, source_file.path):
+                    print "Loading the existing conversion " + output_path + "."
+                    converted = True
+                elif self.conversion_format in OGR_CONVERSION_DRIVERS:
+                    # OGR copies the layers without them passing through python, the documents are read from the copy.
+                    with self.instrumentation.stage(import_name, 'convert'):
+                        converted = copy_ogr_layers(source_file.ogr_path(), ogr_format, output_path,
+                                                    OGR_CONVERSION_DRIVERS.get(self.conversion_format))
+                    if not converted:
+                        output_path = source_file.name + ".json"
+                        print "Writing " + output_path + " instead."
+            if converted:
+                documents = self.instrumentation.timed(iter_converted_features(output_path), import_name, 'parse')
+            else:
+                documents = self.instrumentation.timed(iter_ogr_features(source_file.ogr_path(), ogr_format),
+                                                       import_name, 'parse')
+                if self.conversion_format:
+                    documents = self.instrumentation.timed(
+                        write_geojson(documents, output_path, ndjson=output_path.endswith('.ndjson')),
+                        import_name, 'convert')
+        elif source_file.sheet is not None:
+            documents = self.instrumentation.timed(iter_excel_rows(source_file.path, source_file.sheet, header=header),
+                                                   import_name, 'parse')
+            output_path = source_file.path
+        else:
+            documents = self.instrumentation.timed(
+                self.iter_file_documents(source_file, import_file_format, header=header, encoding=encoding),
+                import_name, 'parse')
+            output_path = source_file.path
+        if self.infer_types and not ogr_format and (source_file.sheet is not None or
+                                                    import_file_format.lower() in ['csv', 'tsv']):
+            key_fields = [field.strip() for field in data_key.split(',')] if data_key else []
+            documents = self.instrumentation.timed(
+                self.typed_documents(documents, source_file, import_name, key_fields=key_fields),
+                import_name, 'types')
+        if tagger:
+            documents = self.instrumentation.timed(tagger.tag(documents), import_name, 'countries')
+        if enricher:
+            documents = self.instrumentation.timed(enricher.enrich(documents), import_name, 'geometries')
+        doc_count = 0
+        documents = iter(documents)
+        while True:
+            # documents are handed to the writer a batch at a time, so its flushes are timed once per batch.
+            batch = list(itertools.islice(documents, self.batch_size))
+            if not batch:
+                break
+            with self.instrumentation.stage(import_name, 'write'):
+                for document in batch:
+                    writer.add(document)
+            doc_count += len(batch)
+        self.instrumentation.count(import_name, 'rows', doc_count)
+        if shared_writer:
+            print("Compared " + str(doc_count) + " documents from " + source_file.name + " with " + collection + ".")
+        else:
+            with self.instrumentation.stage(import_name, 'write'):
+                writer.flush()
+            doc_count = writer.inserted + writer.upserted + writer.matched
+            self.instrumentation.count(import_name, 'documents', doc_count)
+            self.instrumentation.count(import_name, 'errors', writer.errors)
+            print("Imported " + str(doc_count) + " documents into " + collection + " in " +
+                  str(writer.batches) + " batches (" + str(writer.errors) + " errors).")
+            if fail_on_errors and writer.errors:
+                raise ValueError(str(writer.errors) + " documents of " + source_file.name + " could not be written.")
+
+        ## This was optionally if wishing to use mongoimport as opposed
+        ## to importing the files with a custom routine.
+        # print file_path
+        # execute = [os.path.join(bin_dir,"mongoimport"),
+        #            "--host", self.host,
+        #            "--port", str(self.port),
+        #            "-d", self.database.name,
+        #            "-c", collection,
+        #            "--type", import_file_format,
+        #            "--file", file_path]
+        # if file_format.lower() != "json":
+        #     execute.append("--headerline")
+        # if data_key:
+        #     execute += ["--upsertFields",data_key]
+        # if os.path.isfile(os.path.join(bin_dir,"mongoimport")):
+        #     subprocess.call(execute)
+        # else:
+        #     print("Mongo tools not found")
+        return output_path
+
+    def iter_file_documents(self, source_file, import_file_format, header=None, encoding=None):
+        """
+        :param source_file: The SourceFile of the json, csv or tsv data to read.
+        :param import_file_format: One of the mongoimport_supported_formats.
+        :param header: The row of a csv or tsv file that holds the column names.
+        :param encoding: The encoding of a json file, it is detected if not given.
+        :return: A generator of the documents in the file.
+        """
+        file_path = source_file.name
+        if import_file_format.lower() == 'json' and encoding is None:
+            with source_file.open() as data_file:
+                encoding = detect_encoding(data_file, self.encoding_sample_size).get('encoding')
+        with source_file.open() as data_file:
+            if import_file_format.lower() == 'json':
+                if encoding:
+                    print "Encoding detected: " + encoding
+                try:
+                    for json_obj in iter_json_documents(data_file, encoding=encoding):
+                        yield json_obj
+                except ValueError as e:
+                    print "Unable to parse " + file_path + ": " + str(e)
+                    raise
+            elif import_file_format.lower() in ['csv','tsv']:
+                try:
+                    header = int(header)
+                except:
+                    header = 0
+                for line in range(header):
+                    data_file.readline()
+                try:
+                    header_data = data_file.readline()
+                    dialect = csv.Sniffer().sniff(header_data, ['\t',',',';'])
+                except csv.Error:
+                    print "Please check the file " + file_path + " and try again."
+                    raise ValueError("Unable to determine the proper delimiter of " + file_path + ".")
+                csv_data = csv.reader([header_data], dialect)
+                header_row = next(csv_data)
+                print "Header detected as: " + str(header_row)
+                if (self.parse_processes > 1 and source_file.seekable() and
+                        os.path.getsize(source_file.path) > self.parse_range_size):
+                    for row in iter_parallel_csv(source_file.path, data_file.tell(), header_row, dialect.delimiter,
+                                                 processes=self.parse_processes,
+                                                 range_size=self.parse_range_size):
+                        yield row
+                    return
+                dict_reader = csv.DictReader(data_file,header_row,delimiter=dialect.delimiter)
+                for row in dict_reader:
+                    yield row
+
+    def typed_documents(self, documents, source_file, collection, key_fields=None):
+        """
+        :param documents: The rows of a csv, tsv or excel sheet as dicts.
+        :param source_file: The SourceFile the rows are read from.
+        :param collection: The import_name of the source, its data_sources record caches the schema.
+        :param key_fields: Columns that are left as they are so upserts still match existing documents.
+        :return: A generator of the rows with their values converted a batch at a time.
+        """
+        file_name = os.path.basename(source_file.name)
+        documents = iter(documents)
+        sample = []
+        for document in documents:
+            sample.append(document)
+            break
+        if not sample:
+            return
+        columns = sorted(key for key in sample[0] if key)
+        schema = None
+        cached = self.database.data_sources.find_one({'import_name': collection,
+                                                      'schemas': {'$elemMatch': {'file': file_name}}},
+                                                     {'schemas': 1})
+        if cached:
+            for entry in cached.get('schemas'):
+                if entry.get('file') == file_name and sorted(field[0] for field in entry.get('fields')) == columns:
+                    schema = entry
+        if not schema:
+            for document in documents:
+                sample.append(document)
+                if len(sample) >= self.schema_sample_size:
+                    break
+            schema = infer_schema(sample, key_fields=key_fields)
+            schema['file'] = file_name
+            print "Schema inferred as: " + ", ".join(field[0] + " " + field[1] for field in schema.get('fields'))
+            self.database.data_sources.update_one({'import_name': collection},
+                                                  {'$pull': {'schemas': {'file': file_name}}})
+            self.database.data_sources.update_one({'import_name': collection}, {'$push': {'schemas': schema}})
+        if schema.get('point'):
+            print("Coordinates found in " + ", ".join(schema.get('point')) + ", rows get a Point " +
+                  (schema.get('point_field') or 'geometry') + ".")
+        batch = sample
+        for document in documents:
+            if len(batch) >= self.batch_size:
+                for converted in convert_rows(batch, schema):
+                    yield converted
+                batch = []
+            batch.append(document)
+        for converted in convert_rows(batch, schema):
+            yield converted
+
+    def detect_file_encoding(self, source_file, collection, content_hash=None):
+        """
+        :param source_file: The SourceFile to detect the encoding of.
+        :param collection: The import_name of the source, its data_sources record caches the result.
+        :param content_hash: The hash of the downloaded file, otherwise its size and modification time are used.
+        :return: The detected encoding, which is reused until the content hash changes.
+        """
+        if not content_hash:
+            content_hash = file_fingerprint(source_file.path)
+        file_name = os.path.basename(source_file.name)
+        cached = self.database.data_sources.find_one({'import_name': collection,
+                                                      'encodings': {'$elemMatch': {'file': file_name,
+                                                                                   'content_hash': content_hash}}},
+                                                     {'encodings': 1})
+        if cached:
+            for entry in cached.get('encodings'):
+                if entry.get('file') == file_name and entry.get('content_hash') == content_hash:
+                    return entry.get('encoding')
+        with source_file.open() as data_file:
+            result = detect_encoding(data_file, self.encoding_sample_size)
+        self.database.data_sources.update_one({'import_name': collection},
+                                              {'$pull': {'encodings': {'file': file_name}}})
+        self.database.data_sources.update_one({'import_name': collection},
+                                              {'$push': {'encodings': {'file': file_name,
+                                                                       'content_hash': content_hash,
+                                                                       'encoding': result.get('encoding'),
+                                                                       'confidence': result.get('confidence')}}})
+        return result.get('encoding')
+
+    def ensure_key_index(self, collection, data_key):
+        """
+        :param collection: The name of the collection to index.
+        :param data_key: The field documents are upserted on.
+        :return: The name of the index, or None if it could not be created.
+        """
+        # rows without a key are written without the field (see BulkWriter.add) and left out of the index.
+        options = {'unique': True, 'partialFilterExpression': {data_key: {'$exists': True}}}
+        try:
+            try:
+                return self.database[collection].create_index(data_key, **options)
+            except pymongo.errors.OperationFailure as e:
+                # an index from before keys were partial has the same name but other options.
+                if e.code not in [85, 86]:
+                    raise
+                self.database[collection].drop_index(data_key + '_1')
+                return self.database[collection].create_index(data_key, **options)
+        except pymongo.errors.OperationFailure as e:
+            # existing duplicates prevent a unique index, a plain one still avoids collection scans.
+            print "Unable to create a unique index on " + data_key + " for " + collection + ": " + str(e)
+            try:
+                return self.database[collection].create_index(data_key)
+            except pymongo.errors.OperationFailure as e:
+                print e
+                return None
+
+    def country_index(self):
+        """
+        :return: A CountryIndex of the country_codes collection, which is only read once it has been imported.
+        """
+        if not self.countries:
+            self.countries = CountryIndex(self.database.country_codes.find({}, {'_id': 0}))
+        return self.countries
+
+    def country_tagger(self, collection):
+        """
+        :param collection: The import_name of a source.
+        :return: A CountryTagger for the source's country_fields, or None if its documents aren't tagged.
+        """
+        if collection in ['data_sources', 'country_codes']:
+            return None
+        fields = self.country_fields
+        source = self.database.data_sources.find_one({'import_name': collection}, {'country_fields': 1})
+        if source and source.get('country_fields'):
+            fields = [field.strip() for field in source.get('country_fields').split(',') if field.strip()]
+        if fields is not None and not fields:
+            return None
+        index = self.country_index()
+        if not len(index):
+            return None
+        return CountryTagger(index, fields)
+
+    def ensure_country_index(self, collection):
+        """
+        :param collection: The name of the collection to index.
+        :return: The names of the indexes on the ISO codes of dw_country.
+        """
+        names = []
+        for field in ['dw_country.iso2', 'dw_country.iso3']:
+            try:
+                names.append(self.database[collection].create_index(field, sparse=True))
+            except pymongo.errors.OperationFailure as e:
+                print "Unable to create an index on " + field + " for " + collection + ": " + str(e)
+        return names
+
+    def ensure_summary_indexes(self, collection):
+        """
+        Indexes the centroids and bounding boxes of features, a bbox filter like
+        {'dw_bbox.0': {'$lte': east}, 'dw_bbox.1': {'$lte': north}, 'dw_bbox.2': {'$gte': west}, 'dw_bbox.3': {'$gte': south}}
+        is answered from the index without reading any geometry.
+        :param collection: The name of the collection to index.
+        :return: The names of the indexes.
+        """
+        names = [self.ensure_spatial_index(collection, field='dw_centroid')]
+        try:
+            names.append(self.database[collection].create_index([('dw_bbox.0', pymongo.ASCENDING),
+                                                                 ('dw_bbox.1', pymongo.ASCENDING),
+                                                                 ('dw_bbox.2', pymongo.ASCENDING),
+                                                                 ('dw_bbox.3', pymongo.ASCENDING)]))
+        except pymongo.errors.OperationFailure as e:
+            print "Unable to create an index on dw_bbox for " + collection + ": " + str(e)
+        return [name for name in names if name]
+
+    def ensure_spatial_index(self, collection, field='geometry'):
+        """
+        :param collection: The name of the collection to index.
+        :param field: The field holding GeoJSON geometries.
+        :return: The name of the index, or None if it could not be created.
+        """
+        try:
+            return self.database[collection].create_index([(field, pymongo.GEOSPHERE)])
+        except pymongo.errors.OperationFailure as e:
+            print "Unable to create a 2dsphere index on " + field + " for " + collection + ": " + str(e)
+            return None
 
     #Document is actually a python dict
     def submit_document(self, document, collection, data_key=None, compare=None):
@@ -246,250 +739,461 @@ class DB:
                             targetStore=None,
                             source=None,
                             username=None,
-                            password=None):
-        self.geoserver_user = username
-        self.geoserver_user = username
-        self.geoserver_password = password
-        protocol = 'http'
-        if '443' in str(port):
-            protocol = 'https'
-        payload = {
-            "import": {
-                "targetWorkspace": {
-                    "workspace": {
-                        "name": workspace
-                    }
-                },
-                "targetStore": {
-                    "dataStore": {
-                        "name": targetStore
-                    }
-                },
-                "data": {
-                    "type": "file",
-                    "file": source
-                }
-            }
-        }
-        collection = os.path.splitext(os.path.basename(source))[0]
-        authentication = requests.auth.HTTPBasicAuth(self.geoserver_user,self.geoserver_password)
-        url = '{}://{}:{}/geoserver/rest/imports'.format(protocol, host, port)
-        exists_url = '{}://{}:{}/geoserver/rest/layers/{}.html'.format(protocol, host, port, collection)
-        r = requests.get(exists_url, verify=False, auth=authentication)
-        if r.status_code == 401:
-            if self.geoserver_user is None or self.geoserver_password is None:
-                self.geoserver_user = raw_input("Enter geoserver username:")
-                self.geoserver_password = getpass.getpass("Enter geoserver password:")
-                authentication = requests.auth.HTTPBasicAuth(self.geoserver_user,self.geoserver_password)
-        if r.status_code == 200:
-            print "The " + source + " service already exists."
-        r = requests.post(url, json=payload, verify=False, auth=authentication)
-        if r.status_code == 401:
-            if self.geoserver_user is None or self.geoserver_password is None:
-                self.geoserver_user = raw_input("Enter geoserver username:")
-                self.geoserver_password = getpass.getpass("Enter geoserver password:")
-                authentication = requests.auth.HTTPBasicAuth(self.geoserver_user,self.geoserver_password)
-            r = requests.post(url, json=payload, verify=False, auth=authentication)
-        if "Target store does not exist" in r.text:
-            print "The target store does not exist"
-            ds_url = '{}://{}:{}/geoserver/rest/workspaces/sde/datastores'.format(protocol, host, port)
-            ds_payload = {
-                "dataStore" : {
-                    "name" : "imports",
-                    "type" : "PostGIS",
-                    "enabled" : True,
-                    "workspace" : {
-                        "name" : "sde",
-                        "href" : "{}:\/\/{}:{}\/geoserver\/rest\/workspaces\/sde.json".format(protocol,host,port)
-                    },
-                    "connectionParameters" : {
-                        "entry" : [{
-                                "@key" : "schema",
-                                "$" : "public"
-                            }, {
-                                "@key" : "Evictor run periodicity",
-                                "$" : "300"
-                            }, {
-                                "@key" : "Max open prepared statements",
-                                "$" : "50"
-                            }, {
-                                "@key" : "encode functions",
-                                "$" : "false"
-                            }, {
-                                "@key" : "preparedStatements",
-                                "$" : "false"
-                            }, {
-                                "@key" : "database",
-                                "$" : "imports"
-                            }, {
-                                "@key" : "host",
-                                "$" : "localhost"
-                            }, {
-                                "@key" : "Loose bbox",
-                                "$" : "true"
-                            }, {
-                                "@key" : "Estimated extends",
-                                "$" : "true"
-                            }, {
-                                "@key" : "fetch size",
-                                "$" : "1000"
-                            }, {
-                                "@key" : "Expose primary keys",
-                                "$" : "false"
-                            }, {
-                                "@key" : "validate connections",
-                                "$" : "true"
-                            }, {
-                                "@key" : "Support on the fly geometry simplification",
-                                "$" : "true"
-                            }, {
-                                "@key" : "Connection timeout",
-                                "$" : "20"
-                            }, {
-                                "@key" : "create database",
-                                "$" : "false"
-                            }, {
-                                "@key" : "port",
-                                "$" : "5432"
-                            }, {
-                                "@key" : "passwd",
-                                "$" : "importer"
-                            }, {
-                                "@key" : "min connections",
-                                "$" : "1"
-                            }, {
-                                "@key" : "dbtype",
-                                "$" : "postgis"
-                            }, {
-                                "@key" : "namespace",
-                                "$" : "http:\/\/geoserver.sf.net"
-                            }, {
-                                "@key" : "max connections",
-                                "$" : "10"
-                            }, {
-                                "@key" : "Evictor tests per run",
-                                "$" : "3"
-                            }, {
-                                "@key" : "Test while idle",
-                                "$" : "true"
-                            }, {
-                                "@key" : "user",
-                                "$" : "importer"
-                            }, {
-                                "@key" : "Max connection idle time",
-                                "$" : "300"
-                            }
-                        ]
-                    },
-                    "_default" : False,
-                    "featureTypes" : "{}:\/\/{}:{}\/geoserver\/rest\/workspaces\/sde\/datastores\/imports\/featuretypes.json".format(protocol,host,port)
-                }
-            }
-            ds_r = requests.post(ds_url, json=ds_payload, verify=False, auth=authentication)
-            if ds_r.status_code == 201:
-                print "A datastore was successfully created."
-                r = requests.post(url, json=payload, verify=False, auth=authentication)
-            else:
-                return False
-        import_task = r.json().get('import')
-        tasks = import_task.get('tasks')
-        if tasks:
-            requests.post(import_task.get('href'), verify=False, auth=authentication)
-            t_r = requests.get(import_task.get('href'), verify=False, auth=authentication).json()
-            for task in t_r.get('import').get('tasks'):
-                if task.get('state')== "NO_CRS":
-                    requests.put(import_task.get('href'),
-                                 json = {'layer':{'srs':'EPSG:4326'}},
-                                 verify=False,
-                                 auth=authentication)
-                elif task.get('state')== "RUNNING":
-                    print "The " + source + " import task is currently running."
-                elif task.get('state')== "COMPLETED":
-                    print "The " + source + " task completed."
-                elif task.get('state')== "PENDING":
-                    print "The " + source + " task completed."
-                    print "The return value was: " + str(task)
-        else:
-            print "The file: " + source + " was not a valid source."
+                            password=None,
+                            skip_existing=False):
+        """
+        :param source: The path of a file on the GeoServer host, or a list of them to import together. GeoJSON,
+        shapefiles, GeoPackages and FlatGeobuf files (which need GeoServer's FlatGeobuf extension) are importable.
+        :param skip_existing: True to skip files whose layer already exists instead of importing them again.
+        :return: A list of dicts with the state, layer and seconds of each import task.
+        """
+        if username is not None:
+            self.geoserver_user = username
+            self.geoserver_password = password
+        # clients are kept so later uploads reuse their connections and what they know exists.
+        client_key = (host, str(port), workspace, targetStore, skip_existing)
+        client = self.geoserver_clients.get(client_key)
+        if client is None:
+            client = GeoServer(host=host,
+                               port=port,
+                               workspace=workspace,
+                               store=targetStore,
+                               username=self.geoserver_user,
+                               password=self.geoserver_password,
+                               workers=max(self.workers, 2),
+                               skip_existing=skip_existing)
+            self.geoserver_clients[client_key] = client
+        start = time.time()
+        results = client.upload(source)
+        names = []
+        for result in results:
+            uploaded = self.database.data_sources.find_one({'local_file_path': result.get('file')}, {'import_name': 1})
+            name = uploaded.get('import_name') if uploaded else os.path.splitext(os.path.basename(result.get('file')))[0]
+            self.instrumentation.record(name, 'upload', result.get('seconds') or 0)
+            names.append(name)
+        self.instrumentation.finish(self.database, sources=names, kind='upload', seconds=time.time() - start)
+        return results
 
-    def get_source_data(self, url, local_filename="downloaded_file"):
+    def get_source_data(self, url, local_filename="downloaded_file", progress=True, source=None, conditional=False):
+        """
+        :param url: The url to download.
+        :param local_filename: The name of the folder and file to save the download as.
+        :param progress: Whether to print a progress bar.
+        :param source: A data_sources record, its etag, last_modified and content_length are updated after a download
+        and its download_status is set to 'downloaded', 'not_modified' or 'failed'.
+        :param conditional: Whether to send the source's validators so an unchanged file isn't downloaded again.
+        :return: The path of the downloaded file, or None if the download failed or the file was unchanged.
+        """
+        if source is None:
+            source = {}
+        source['download_status'] = 'failed'
         if not url:
             print "A data_url must exist to download and import the data."
-        print "Downloading " + local_filename + " from " + url
-        r = requests.get(url, stream=True)
-        if int(r.status_code) >= 400:
-            print str(url) + " returned " + str(int(r.status_code)) + " and is invalid."
             return None
         data_path = os.path.join(self.temp_dir,local_filename)
         if not os.path.isdir(data_path):
             os.mkdir(data_path)
-        with open(os.path.join(data_path,local_filename), 'wb') as f:
-            total_size = r.headers.get('content-length')
+        file_path = os.path.join(data_path,local_filename)
+        part_path = file_path + '.part'
+        validator_path = part_path + '.validator'
+        headers = {}
+        if conditional:
+            if source.get('etag'):
+                headers['If-None-Match'] = source.get('etag')
+            if source.get('last_modified'):
+                headers['If-Modified-Since'] = source.get('last_modified')
+        # an interrupted download is resumed as long as the server still has the same file.
+        resume_from = 0
+        if os.path.isfile(part_path) and os.path.isfile(validator_path):
+            with open(validator_path, 'r') as validator_file:
+                validator = validator_file.read().strip()
+            resume_from = os.path.getsize(part_path)
+            if validator and resume_from:
+                headers['Range'] = 'bytes={}-'.format(resume_from)
+                headers['If-Range'] = validator
+                headers['Accept-Encoding'] = 'identity'
+        print "Downloading " + local_filename + " from " + url
+        try:
+            r = self.session.get(url, stream=True, headers=headers)
+        except requests.exceptions.RequestException as e:
+            print str(url) + " could not be reached: " + str(e)
+            return None
+        if r.status_code == 416 and 'Range' in headers:
+            # the partial file is already complete, or longer than the file now is, so it is downloaded again.
+            print "The partial download of " + local_filename + " can't be resumed, it is started over."
+            r.close()
+            for path in [part_path, validator_path]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            for header in ['Range', 'If-Range', 'Accept-Encoding']:
+                headers.pop(header)
+            resume_from = 0
+            try:
+                r = self.session.get(url, stream=True, headers=headers)
+            except requests.exceptions.RequestException as e:
+                print str(url) + " could not be reached: " + str(e)
+                return None
+        if r.status_code == 304:
+            print local_filename + " has not changed since it was last downloaded."
+            source['download_status'] = 'not_modified'
+            r.close()
+            return None
+        if int(r.status_code) >= 400:
+            print str(url) + " returned " + str(int(r.status_code)) + " and is invalid."
+            return None
+        total_size = r.headers.get('content-length')
+        content_hash = hashlib.sha256()
+        if r.status_code == 206:
+            print "Resuming " + local_filename + " at byte " + str(resume_from) + "."
+            mode = 'ab'
+            written_content = resume_from
+            with open(part_path, 'rb') as part_file:
+                for chunk in iter(lambda: part_file.read(self.chunk_size), ''):
+                    content_hash.update(chunk)
             if total_size:
-                total_size = float(total_size)
+                total_size = float(total_size) + resume_from
+        else:
+            mode = 'wb'
             written_content = 0
-            chunk_size=4096
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    f.write(chunk)
-                    written_content += chunk_size
-                    print_status(written_content, total_size)
+            if total_size:
+                total_size = float(total_size)
+            validator = r.headers.get('etag')
+            if not validator or validator.startswith('W/'):
+                validator = r.headers.get('last-modified')
+            if validator:
+                with open(validator_path, 'w') as validator_file:
+                    validator_file.write(validator)
+            elif os.path.isfile(validator_path):
+                os.remove(validator_path)
+        try:
+            with open(part_path, mode) as f:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        content_hash.update(chunk)
+                        written_content += len(chunk)
+                        if progress:
+                            print_status(written_content, total_size)
+        except requests.exceptions.RequestException as e:
+            print("\nThe download of " + local_filename + " was interrupted and will be resumed next time: " + str(e))
+            return None
+        # iter_content decodes compressed responses so only identity transfers can be compared to content-length.
+        if total_size and not r.headers.get('content-encoding') and written_content < total_size:
+            print("\nThe download of " + local_filename + " ended early and will be resumed next time.")
+            return None
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        if self.cache:
+            file_path = self.cache.add(part_path, content_hash.hexdigest(), local_filename)
+        else:
+            os.rename(part_path, file_path)
+        if os.path.isfile(validator_path):
+            os.remove(validator_path)
+        source['etag'] = r.headers.get('etag')
+        source['last_modified'] = r.headers.get('last-modified')
+        source['content_length'] = written_content
+        source['content_hash'] = content_hash.hexdigest()
+        source['download_status'] = 'downloaded'
         print("\nFinished downloading " + local_filename + ".")
-        return os.path.abspath(os.path.join(data_path,local_filename))
-
-    ##When implementing this the user should only have permissions to a limited set
-    ##set of directories to prevent absolute file paths from being extracted. (i.e./etc/hosts)
-    def extract_data(self, zip_file):
-        zips = ['.zip','.gz','.kmz']
-        for ext in zips:
-            if ext in os.path.splitext(os.path.basename(zip_file))[1]:
-                zip_folder = working_folder(zip_file)
-                with ZipFile(zip_file,'r') as zip:
-                    zip.extractall(zip_folder)
-                return zip_folder
-
-    def convert_compressed_format(self, file_path, format):
-        extracted_path = self.extract_data(file_path)
-        files = self.get_files_by_type(extracted_path,self.compressed_formats.get(format))
-        file_paths = []
-        for file_name in files:
-            if self.compressed_formats.get(format) in self.ogr_formats:
-                file_paths += [os.path.join(self.convert_to_json(os.path.join(file_name), self.ogr_formats.get(self.compressed_formats.get(format))))]
+        if self.cache:
+            # the current download of every source is kept whatever the budget.
+            self.cache.evict(keep=self.database.data_sources.distinct('content_hash') + [source['content_hash']])
+        return os.path.abspath(file_path)
+
+    def archive_files(self, file_path, format):
+        """
+        :param file_path: A zip or gzip archive.
+        :param format: The data_format of the archive.
+        :return: A list of SourceFiles for the members matching the format, which are read without extracting them.
+        """
+        if file_path.lower().endswith('.gz'):
+            return [SourceFile(file_path)]
+        extension = self.compressed_formats.get(format.lower())
+        with ZipFile(file_path, 'r') as zip:
+            members = [member for member in zip.namelist()
+                       if member.lower().endswith(extension) and not member.startswith('__MACOSX/')]
+        return [SourceFile(file_path, member) for member in members]
+
+    def excel_files(self, file_path):
+        """
+        :param file_path: An xls or xlsx workbook.
+        :return: A list of SourceFiles, one for each sheet, which are read without loading the whole workbook.
+        """
+        openpyxl = lazy_import('openpyxl', required=False)
+        if openpyxl and file_path.lower().endswith('.xlsx'):
+            book = openpyxl.load_workbook(file_path, read_only=True)
+            sheet_names = book.sheetnames
+            if hasattr(book, 'close'):
+                book.close()
+        else:
+            book = lazy_import('xlrd').open_workbook(file_path, on_demand=True)
+            sheet_names = book.sheet_names()
+            book.release_resources()
+        return [SourceFile(file_path, sheet=sheet_name) for sheet_name in sheet_names]
+
+    def update_data(self, workers=None, per_host=None, import_names=None, force=False):
+        """
+        :param workers: The number of sources to download and import at once (defaults to self.workers).
+        :param per_host: The number of simultaneous downloads allowed from one host (defaults to self.per_host).
+        :param import_names: Only these sources are refreshed if given.
+        :param force: Whether to refresh the sources even if they aren't due.
+        :return: A dict of the download and import seconds spent on each refreshed source.
+        """
+        workers = workers or self.workers
+        per_host = per_host or self.per_host
+        start = time.time()
+        timings = {}
+        self.setup()
+        query = {'import_name': {'$in': import_names}} if import_names else {}
+        sources = [source for source in self.database.data_sources.find(query) if force or self.is_due(source)]
+        if workers <= 1:
+            for source in sources:
+                try:
+                    self.refresh_source(source, timings)
+                except Exception as e:
+                    print "Unable to refresh " + str(source.get('import_name')) + ": " + str(e)
+        else:
+            host_limits = {}
+            for source in sources:
+                host = urlparse.urlparse(source.get('data_url') or '').netloc
+                host_limits.setdefault(host, threading.BoundedSemaphore(per_host))
+            download_pool = ThreadPool(workers)
+            import_pool = ThreadPool(workers)
+
+            # each download hands its file to the import pool so parsing overlaps the remaining downloads.
+            def download(source):
+                try:
+                    with host_limits[urlparse.urlparse(source.get('data_url') or '').netloc]:
+                        # a stream is loaded while it downloads so it holds its connection until it is done.
+                        if self.streams(source):
+                            self.stream_source(source, timings)
+                            return None
+                        downloaded_file = self.download_source(source, timings, progress=False)
+                except Exception as e:
+                    print "Unable to download " + str(source.get('import_name')) + ": " + str(e)
+                    return None
+                if source.get('download_status') == 'failed':
+                    return None
+                return import_pool.apply_async(import_source, (source, downloaded_file))
+
+            def import_source(source, downloaded_file):
+                try:
+                    self.import_source(source, downloaded_file, timings)
+                except Exception as e:
+                    print "Unable to import " + str(source.get('import_name')) + ": " + str(e)
+
+            pending = download_pool.map(download, interleave_hosts(sources), chunksize=1)
+            download_pool.close()
+            for result in pending:
+                if result:
+                    result.wait()
+            import_pool.close()
+            download_pool.join()
+            import_pool.join()
+        print_timings(timings, time.time() - start)
+        self.instrumentation.finish(self.database, kind='refresh', seconds=time.time() - start)
+        return timings
+
+    def plan(self, import_names=None, head=True):
+        """
+        Works out what a refresh would do without downloading or writing anything.
+        :param import_names: Only these sources are planned if given.
+        :param head: Whether to send a HEAD request for each due source to estimate its transfer.
+        :return: A list of dicts with the import_name, data_format, whether it is due, when it is next due and,
+        for due sources, the status and content_length the server reports.
+        """
+        query = {'import_name': {'$in': import_names}} if import_names else {}
+        entries = []
+        for source in self.database.data_sources.find(query):
+            entries.append({'import_name': source.get('import_name'),
+                            'data_format': source.get('data_format'),
+                            'due': self.is_due(source),
+                            'next_refresh': next_refresh(source.get('data_date'), source.get('refresh_rate')),
+                            'status': None,
+                            'content_length': None,
+                            'source': source})
+
+        def check(entry):
+            source = entry.pop('source')
+            if not entry['due'] or not head:
+                return entry
+            if not source.get('data_url'):
+                entry['status'] = 'no data_url'
+                return entry
+            headers = {}
+            if self.database[source.get('import_name')].find_one():
+                if source.get('etag'):
+                    headers['If-None-Match'] = source.get('etag')
+                if source.get('last_modified'):
+                    headers['If-Modified-Since'] = source.get('last_modified')
+            try:
+                r = self.session.head(source.get('data_url').lower(), headers=headers, allow_redirects=True, timeout=30)
+            except requests.exceptions.RequestException:
+                entry['status'] = 'unreachable'
+                return entry
+            if r.status_code == 304:
+                entry['status'] = 'not modified'
+                entry['content_length'] = 0
+            elif r.status_code >= 400:
+                entry['status'] = 'returned ' + str(r.status_code)
             else:
-                file_paths += [file_name]
-        return file_paths
-
-    def convert_from_excel(self, file_path):
-        csv_folder = working_folder(file_path)
-        book = xlrd.open_workbook(file_path)
-        sheet_names = book.sheet_names()
-        file_paths = []
-        for sheet_name in sheet_names:
-            csv_path = os.path.join(csv_folder,sheet_name)+'.csv'
-            with open(csv_path, 'w') as csv_file:
-                csv_writer = unicodecsv.writer(csv_file, quoting=unicodecsv.QUOTE_ALL)
-                sheet = book.sheet_by_name(sheet_name)
-                for row_num in range(sheet.nrows):
-                    csv_writer.writerow(sheet.row_values(row_num))
-            file_paths += [csv_path]
-        return file_paths
-
-    def update_data(self):
-        for source in self.database.data_sources.find():
-            now = int('{:%Y%m%d%H%M%S}'.format(datetime.datetime.now()))
-            collection_name = source.get('import_name')
-            if now < long(self.get_expiration(source.get('data_date'),source.get('refresh_rate'))):
-                continue
-            local_filename = collection_name + '.' + self.download_formats.get(source.get('data_format').lower())
-            collection = self.database[collection_name]
-            downloaded_file = None
-            if not collection.find_one():
-                downloaded_file = self.get_source_data(source.get('data_url').lower(),local_filename=local_filename)
-            if downloaded_file:
-                self.import_file(downloaded_file,source.get('data_format'),collection=collection_name,header=source.get('header'))
-            source['data_date'] = now
-            source['local_file_paths'] = downloaded_file
-            self.submit_document(source, 'data_sources', data_key='import_name')
+                entry['status'] = 'download'
+                if r.headers.get('content-length'):
+                    entry['content_length'] = int(r.headers.get('content-length'))
+            return entry
+
+        due_entries = [entry for entry in entries if entry['due'] and head]
+        if len(due_entries) > 1:
+            pool = ThreadPool(min(max(self.workers, 4), len(due_entries)))
+            try:
+                entries = pool.map(check, entries)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries = [check(entry) for entry in entries]
+        return entries
+
+    def is_due(self, source):
+        due = next_refresh(source.get('data_date'), source.get('refresh_rate'))
+        return due is not None and datetime.datetime.now() >= due
+
+    def streams(self, source):
+        return self.streaming and (source.get('data_format') or '').lower() in self.streaming_formats
+
+    def refresh_source(self, source, timings=None, progress=True):
+        """
+        Downloads and imports a source, or streams it if it can be. A failed download leaves the source's
+        data_date alone so it is retried rather than waiting for its next period.
+        """
+        if self.streams(source):
+            self.stream_source(source, timings)
+        else:
+            downloaded_file = self.download_source(source, timings, progress=progress)
+            if source.get('download_status') == 'failed':
+                return
+            self.import_source(source, downloaded_file, timings)
+
+    def stream_source(self, source, timings=None):
+        """
+        Loads a source as it downloads, the response goes through a bounded queue to the parser and straight
+        into mongo without being written to disk.
+        :param source: A data_sources record in one of the streaming_formats, its refresh fields are updated
+        as with download_source and import_source.
+        :return: True if the source was loaded.
+        """
+        start = time.time()
+        collection_name = source.get('import_name')
+        data_format = source.get('data_format').lower()
+        url = source.get('data_url').lower()
+        source['download_status'] = 'failed'
+        headers = {}
+        # as with download_source a source that was already imported is only loaded again if it changed.
+        if self.database[collection_name].find_one():
+            if source.get('etag'):
+                headers['If-None-Match'] = source.get('etag')
+            if source.get('last_modified'):
+                headers['If-Modified-Since'] = source.get('last_modified')
+        print "Streaming " + collection_name + " from " + url
+        try:
+            r = self.session.get(url, stream=True, headers=headers)
+        except requests.exceptions.RequestException as e:
+            print str(url) + " could not be reached: " + str(e)
+            return False
+        if r.status_code == 304:
+            print collection_name + " has not changed since it was last downloaded."
+            source['download_status'] = 'not_modified'
+            r.close()
+            self.import_source(source, None, timings)
+            return False
+        if int(r.status_code) >= 400:
+            print str(url) + " returned " + str(int(r.status_code)) + " and is invalid."
+            r.close()
+            return False
+        stream = StreamSource(r, collection_name + '.' + self.download_formats.get(data_format),
+                              chunk_size=self.chunk_size,
+                              queue_size=self.stream_queue_size,
+                              gzipped=data_format.startswith('gzipped_'))
+        data_key = source.get('data_key') or None
+        load_mode = source.get('load_mode') or self.load_mode
+        if not data_key and load_mode == 'upsert':
+            # keyless sources are replaced on each refresh, a swap does that without emptying the collection
+            # while a stream that may still fail is loading.
+            load_mode = 'swap'
+        self.database.data_sources.update_one({'import_name': collection_name}, {'$unset': {'import_hash': ''}})
+        try:
+            self.import_file([stream], data_format,
+                             collection=collection_name,
+                             data_key=data_key,
+                             header=source.get('header'),
+                             load_mode=load_mode)
+        except Exception as e:
+            print "The stream of " + collection_name + " failed: " + str(e)
+            return False
+        finally:
+            stream.close()
+        self.instrumentation.count(collection_name, 'bytes', stream.size)
+        source['etag'] = r.headers.get('etag')
+        source['last_modified'] = r.headers.get('last-modified')
+        source['content_length'] = stream.size
+        source['content_hash'] = stream.content_hash.hexdigest()
+        source['download_status'] = 'downloaded'
+        self.database.data_sources.update_one({'import_name': collection_name},
+                                              {'$set': {'import_hash': source['content_hash']}})
+        if timings is not None:
+            timings.setdefault(collection_name, {})['download'] = time.time() - start
+        self.import_source(source, None, timings)
+        return True
+
+    def download_source(self, source, timings=None, progress=True):
+        start = time.time()
+        collection_name = source.get('import_name')
+        local_filename = collection_name + '.' + self.download_formats.get(source.get('data_format').lower())
+        collection = self.database[collection_name]
+        # sources that were already imported are only downloaded again when the server reports a change.
+        with self.instrumentation.stage(collection_name, 'download'):
+            downloaded_file = self.get_source_data(source.get('data_url').lower(),
+                                                   local_filename=local_filename,
+                                                   progress=progress,
+                                                   source=source,
+                                                   conditional=collection.find_one() is not None)
+        if downloaded_file:
+            self.instrumentation.count(collection_name, 'bytes', os.path.getsize(downloaded_file))
+        if timings is not None:
+            timings.setdefault(collection_name, {})['download'] = time.time() - start
+        return downloaded_file
+
+    def import_source(self, source, downloaded_file, timings=None):
+        start = time.time()
+        now = int('{:%Y%m%d%H%M%S}'.format(datetime.datetime.now()))
+        collection_name = source.get('import_name')
+        if downloaded_file:
+            data_key = source.get('data_key') or None
+            load_mode = source.get('load_mode') or self.load_mode
+            if self.is_current(collection_name, source.get('content_hash')):
+                print collection_name + " already holds the downloaded data."
+            else:
+                if not data_key and load_mode == 'upsert':
+                    # without a key the new rows can't be matched to the old ones, so a refresh replaces them,
+                    # a swap does that without emptying the collection before the import is known to succeed.
+                    load_mode = 'swap'
+                self.import_file(downloaded_file,
+                                 source.get('data_format'),
+                                 collection=collection_name,
+                                 data_key=data_key,
+                                 header=source.get('header'),
+                                 content_hash=source.get('content_hash'),
+                                 load_mode=load_mode)
+        # only the refresh fields are set, import_file maintains others like local_file_path itself.
+        refreshed = {'data_date': now}
+        if downloaded_file:
+            refreshed['local_file_paths'] = downloaded_file
+        for field in ['etag', 'last_modified', 'content_length', 'content_hash']:
+            if field in source:
+                refreshed[field] = source.get(field)
+        self.database.data_sources.update_one({'import_name': collection_name}, {'$set': refreshed})
+        if timings is not None:
+            timings.setdefault(collection_name, {})['import'] = time.time() - start
 
     def get_expiration(self, date, mag):
         """
@@ -497,41 +1201,1196 @@ class DB:
         :param mag: The order of magnitude for expiration (0=sec,1=min,...).
         :return: An integer representing the expiration.
         """
-        if not mag:
-            mag = 7
-        if not date:
-            date = 0
-        return long(long(date)+math.pow(100,float(mag)))
-
-    def convert_to_json(self, file_path, format):
-        driver = ogr.GetDriverByName(format)
-        json_path = file_path + ".json"
-        with open(json_path, 'w') as json_file:
-            driver_source = driver.Open(file_path)
-            features_dict = {"type": "FeatureCollection",
-                             "features": []
-                             }
-            for layer in driver_source:
-                for feature in layer:
-                    features_dict["features"].append(json.loads(feature.ExportToJson()))
-            json.dump(features_dict, json_file)
+        expiration = next_refresh(date, mag)
+        if expiration is None:
+            return long(99991231235959)
+        return long('{:%Y%m%d%H%M%S}'.format(expiration))
+
+    def run_scheduler(self, workers=None, jitter=60, max_backoff=86400, poll_interval=900):
+        """
+        Refreshes each source as it comes due until interrupted, see RefreshScheduler.
+        """
+        self.setup()
+        scheduler = RefreshScheduler(self,
+                                     workers=workers or max(self.workers, 2),
+                                     jitter=jitter,
+                                     max_backoff=max_backoff,
+                                     poll_interval=poll_interval)
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            print "Stopping the scheduler."
+        finally:
+            scheduler.stop()
+
+    def convert_to_json(self, file_path, format, ndjson=False):
+        json_path = file_path + (".ndjson" if ndjson else ".json")
+        for feature in write_geojson(iter_ogr_features(file_path, format), json_path, ndjson=ndjson):
+            pass
         return json_path
 
-    def get_files_by_type(self, directory, type):
-        files = []
-        for file_name in os.listdir(directory):
-            if file_name.endswith(type):
-                files += [os.path.join(directory,file_name)]
-        return files
+    def convert_ogr(self, file_path, format):
+        """
+        :param file_path: A file OGR can open.
+        :param format: The name of the OGR driver to open it with.
+        :return: The path of its conversion to the conversion_format, GeoJSON if OGR can't write that format.
+        """
+        driver_name = OGR_CONVERSION_DRIVERS.get(self.conversion_format)
+        if driver_name:
+            output_path = self.conversion_path(file_path)
+            if copy_ogr_layers(file_path, format, output_path, driver_name):
+                return output_path
+        return self.convert_to_json(file_path, format, ndjson=self.conversion_format == 'ndjson')
+
+    def export(self, collection, file_path, format=None, fields=None, query=None, bbox=None,
+               geometry_field='geometry', batch_size=10000):
+        """
+        Streams a collection to NDJSON, a GeoJSON FeatureCollection or CSV a cursor batch at a time, so the export
+        takes the same memory however large the collection is.
+        :param collection: The name of the collection to export.
+        :param file_path: The file to write, it is only renamed into place once it is complete. A .gz file is
+        gzipped and a .zip file holds the export under its own name, ready for upload_to_geoserver.
+        :param format: 'ndjson', 'geojson' or 'csv', taken from the extension of file_path if not given.
+        A .zip file without another extension holds GeoJSON.
+        :param fields: Only these fields (or feature properties) are read and written.
+        :param query: A mongo query the documents have to match.
+        :param bbox: [west, south, east, north], only documents whose geometry intersects it are exported,
+        which the 2dsphere index on geometry answers.
+        :param geometry_field: The geometry to write, like dw_simplified_0_01 for a light preview.
+        :param batch_size: The number of documents read from mongo at a time.
+        :return: The number of documents written.
+        """
+        name, extension = os.path.splitext(file_path)
+        compression = extension.lower() if extension.lower() in ['.gz', '.zip'] else None
+        if compression:
+            extension = os.path.splitext(name)[1]
+        # a zip is meant for GeoServer, which imports GeoJSON.
+        format = format or EXPORT_FORMATS.get(extension.lower()) or ('geojson' if compression == '.zip' else None)
+        if format not in ['ndjson', 'geojson', 'csv']:
+            raise ValueError("The export format of " + file_path + " isn't known, it can be ndjson, geojson or csv.")
+        filters = [{'dw_deleted': {'$ne': True}}]
+        if query:
+            filters.append(query)
+        if bbox:
+            filters.append({'geometry': {'$geoIntersects': {'$geometry': bbox_polygon(bbox)}}})
+        # only the fields that are written are read from mongo.
+        if fields:
+            projection = {'_id': 0, 'type': 1, geometry_field: 1, 'dw_bbox': 1}
+            for field in fields:
+                projection[field] = 1
+                projection['properties.' + field] = 1
+        else:
+            projection = {'_id': 0, 'dw_key': 0, 'dw_hash': 0, 'dw_deleted': 0, 'dw_centroid': 0}
+            for field in ['geometry'] + [simplified_field(tolerance) for tolerance in self.simplify_tolerances or []]:
+                if field != geometry_field:
+                    projection[field] = 0
+        cursor = self.database[collection].find({'$and': filters}, projection, batch_size=batch_size)
+
+        if compression == '.zip':
+            if not extension:
+                extension = {'ndjson': '.ndjson', 'geojson': '.json', 'csv': '.csv'}.get(format)
+            member = os.path.basename(os.path.splitext(name)[0]) + extension
+            export_path = os.path.join(os.path.dirname(os.path.abspath(file_path)), member + '.part')
+        else:
+            export_path = file_path + '.part'
+        start = time.time()
+        try:
+            with self.instrumentation.stage(collection, 'export'):
+                with (gzip.open(export_path, 'wb') if compression == '.gz' else open(export_path, 'wb')) as export_file:
+                    count = write_export(cursor, export_file, format, fields=fields, geometry_field=geometry_field)
+                if compression == '.zip':
+                    with ZipFile(file_path + '.part', 'w', ZIP_DEFLATED, allowZip64=True) as archive:
+                        archive.write(export_path, member)
+                    os.remove(export_path)
+                    export_path = file_path + '.part'
+        except:
+            cursor.close()
+            for part_path in [export_path, file_path + '.part']:
+                if os.path.isfile(part_path):
+                    os.remove(part_path)
+            raise
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+        os.rename(export_path, file_path)
+        self.instrumentation.count(collection, 'exported', count)
+        print("Exported {} documents from {} to {} in {:.2f}s.".format(count, collection, file_path,
+                                                                       time.time() - start))
+        return count
+
+    def conversion_path(self, file_path):
+        if self.conversion_format in ['ndjson', 'gpkg', 'fgb']:
+            return file_path + "." + self.conversion_format
+        return file_path + ".json"
+
+
+class BulkWriter:
+    """
+    Buffers documents for a collection and sends them as unordered bulk writes.
+    Documents with a value for data_key are upserted on that key, the rest are inserted without the field so
+    they stay outside its unique index. Duplicate key errors (E11000) are counted but otherwise ignored, as in
+    DB.submit_document.
+    """
+
+    def __init__(self, collection, data_key=None, batch_size=1000):
+        self.collection = collection
+        self.data_key = data_key
+        self.batch_size = max(int(batch_size or 1), 1)
+        self.operations = []
+        self.batches = 0
+        self.inserted = 0
+        self.upserted = 0
+        self.matched = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    def add(self, document):
+        key = document.get(self.data_key) if self.data_key else None
+        if key is not None and key != '':
+            self.add_operation(pymongo.UpdateOne({self.data_key: key},
+                                                 {"$set": document},
+                                                 upsert=True))
+        else:
+            if self.data_key:
+                document.pop(self.data_key, None)
+            self.add_operation(pymongo.InsertOne(document))
+
+    def add_operation(self, operation):
+        self.operations.append(operation)
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.operations:
+            return
+        operations = self.operations
+        self.operations = []
+        self.batches += 1
+        try:
+            result = self.collection.bulk_write(operations, ordered=False).bulk_api_result
+        except pymongo.errors.BulkWriteError as bwe:
+            result = bwe.details
+        duplicates = 0
+        errors = 0
+        for write_error in result.get('writeErrors', []):
+            if write_error.get('code') == 11000:
+                duplicates += 1
+            else:
+                errors += 1
+                print write_error.get('errmsg')
+        self.inserted += result.get('nInserted', 0)
+        self.upserted += result.get('nUpserted', 0)
+        self.matched += result.get('nMatched', 0)
+        self.duplicates += duplicates
+        self.errors += errors
+        print("Batch {}: {} inserted, {} upserted, {} updated, {} duplicates, {} errors.".format(
+            self.batches, result.get('nInserted', 0), result.get('nUpserted', 0),
+            result.get('nMatched', 0), duplicates, errors))
+
+
+class RefreshScheduler:
+    """
+    Keeps the data sources in a priority queue ordered by when each is next due and sleeps until the first
+    one is, so the cost of a refresh cycle depends on the number of due sources rather than all of them.
+    Due sources are refreshed by a pool of workers. A random jitter spreads out sources that come due
+    together and a host whose downloads fail is retried with an exponential backoff.
+    """
+
+    def __init__(self, db, workers=2, jitter=60, max_backoff=86400, poll_interval=900, retry_delay=60):
+        self.db = db
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.pool = ThreadPool(workers)
+        self.queue = []
+        self.scheduled = set()
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+    def schedule(self, import_name, due):
+        with self.lock:
+            heapq.heappush(self.queue, (due, import_name))
+            self.scheduled.add(import_name)
+        self.wakeup.set()
+
+    def load_sources(self):
+        # new data_sources records are picked up, the ones already queued or running keep their place.
+        for source in self.db.database.data_sources.find({}, {'import_name': 1, 'data_date': 1, 'refresh_rate': 1}):
+            import_name = source.get('import_name')
+            if import_name in self.scheduled:
+                continue
+            due = next_refresh(source.get('data_date'), source.get('refresh_rate'))
+            if due is not None:
+                self.schedule(import_name, timestamp(due))
+
+    def run(self):
+        self.running = True
+        next_poll = 0
+        try:
+            while self.running:
+                if time.time() >= next_poll:
+                    self.load_sources()
+                    next_poll = time.time() + self.poll_interval
+                with self.lock:
+                    due, import_name = self.queue[0] if self.queue else (next_poll, None)
+                    if import_name and due <= time.time():
+                        heapq.heappop(self.queue)
+                    else:
+                        import_name = None
+                        self.wakeup.clear()
+                if import_name:
+                    self.pool.apply_async(self.refresh, (import_name,))
+                else:
+                    self.wakeup.wait(max(min(due, next_poll) - time.time(), 0))
+        finally:
+            # refreshes that already started are allowed to finish.
+            self.pool.close()
+            self.pool.join()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def refresh(self, import_name):
+        source = self.db.database.data_sources.find_one({'import_name': import_name})
+        if not source:
+            with self.lock:
+                self.scheduled.discard(import_name)
+            return
+        host = urlparse.urlparse(source.get('data_url') or '').netloc
+        try:
+            self.db.refresh_source(source, progress=False)
+            if source.get('download_status') == 'failed':
+                raise IOError("The download of " + import_name + " failed.")
+        except Exception as e:
+            self.db.instrumentation.count(import_name, 'failures')
+            self.db.instrumentation.finish(self.db.database, sources=[import_name], kind='scheduled')
+            with self.lock:
+                self.failures[host] = self.failures.get(host, 0) + 1
+                failures = self.failures[host]
+            delay = min(self.retry_delay * math.pow(2, failures - 1), self.max_backoff)
+            print str(e) + " Retrying in " + str(int(delay)) + " seconds."
+            self.schedule(import_name, time.time() + delay + random.uniform(0, self.jitter))
+            return
+        self.db.instrumentation.finish(self.db.database, sources=[import_name], kind='scheduled')
+        with self.lock:
+            self.failures.pop(host, None)
+        due = next_refresh(datetime.datetime.now(), source.get('refresh_rate'))
+        if due is None:
+            with self.lock:
+                self.scheduled.discard(import_name)
+        else:
+            self.schedule(import_name, timestamp(due) + random.uniform(0, self.jitter))
+
+
+class DiffWriter:
+    """
+    Compares documents with the previous import of a collection and only writes the new and changed ones.
+    Each document is stored with its key (dw_key) and a hash of its content (dw_hash), documents that are
+    missing from the new import are removed, or marked dw_deleted if tombstone is set, by finish(). Documents
+    without a value for every key field are keyed by their hash, like the documents of a source without keys.
+    added and changed count the writes that succeeded, nothing is removed if any write failed.
+    """
+
+    def __init__(self, collection, key_fields=None, batch_size=1000, tombstone=False):
+        self.collection = collection
+        self.key_fields = key_fields or []
+        self.batch_size = max(int(batch_size or 1), 1)
+        self.tombstone = tombstone
+        self.writer = BulkWriter(collection, batch_size=batch_size)
+        self.lock = threading.Lock()
+        # only the keys and hashes of the previous import are held in memory, tombstones have no hash.
+        self.existing = {}
+        for document in collection.find({'dw_key': {'$exists': True}},
+                                        {'_id': 0, 'dw_key': 1, 'dw_hash': 1, 'dw_deleted': 1}):
+            self.existing[document.get('dw_key')] = None if document.get('dw_deleted') else document.get('dw_hash')
+        self.seen = set()
+        self.added = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.duplicates = 0
+
+    def add(self, document):
+        content_hash = document_hash(document)
+        values = [document.get(field) for field in self.key_fields]
+        keyed = values and all(value is not None and value != '' for value in values)
+        key = repr(values) if keyed else content_hash
+        with self.lock:
+            if key in self.seen:
+                self.duplicates += 1
+                return
+            self.seen.add(key)
+            previous = self.existing.get(key)
+            if previous == content_hash:
+                self.unchanged += 1
+                return
+            query = {'dw_key': key}
+            if keyed and key not in self.existing:
+                # a document loaded on data_key before incremental imports has no dw_key but is replaced
+                # rather than duplicated, its key fields may still have a unique index.
+                legacy = dict(zip(self.key_fields, values))
+                legacy['dw_key'] = {'$exists': False}
+                query = {'$or': [query, legacy]}
+            document['dw_key'] = key
+            document['dw_hash'] = content_hash
+            self.writer.add_operation(pymongo.ReplaceOne(query, document, upsert=True))
+
+    def failed(self):
+        return self.writer.errors + self.writer.duplicates > 0
+
+    def finish(self):
+        with self.lock:
+            self.writer.flush()
+        # replacements of documents from before incremental imports are matched rather than upserted.
+        self.added = self.writer.upserted
+        self.changed = self.writer.matched
+        if self.failed():
+            print(str(self.writer.errors + self.writer.duplicates) + " documents of " + self.collection.name +
+                  " could not be written, no documents are removed.")
+            self.existing = {}
+            self.seen = set()
+            return
+        missing = [key for key, content_hash in self.existing.iteritems()
+                   if content_hash is not None and key not in self.seen]
+        for start in xrange(0, len(missing), self.batch_size):
+            keys = {'dw_key': {'$in': missing[start:start + self.batch_size]}}
+            if self.tombstone:
+                self.removed += self.collection.update_many(keys, {'$set': {'dw_deleted': True}}).modified_count
+            else:
+                self.removed += self.collection.delete_many(keys).deleted_count
+        # documents loaded before incremental imports have no key to compare, their replacements were added.
+        self.removed += self.collection.delete_many({'dw_key': {'$exists': False}}).deleted_count
+        self.existing = {}
+        self.seen = set()
+
+
+class SourceFile:
+    """
+    A file to import, either on disk or a member of a zip or gzip archive that is read without extracting it.
+    """
+
+    def __init__(self, path, member=None, sheet=None):
+        self.path = path
+        self.member = member
+        self.sheet = sheet
+        if sheet is not None:
+            self.name = os.path.join(path, sheet)
+        elif member:
+            # files derived from a member, like its GeoServer json, are written next to the archive.
+            self.name = os.path.join(working_folder(path), os.path.basename(member))
+        elif path.lower().endswith('.gz'):
+            self.name = os.path.splitext(path)[0]
+        else:
+            self.name = path
+
+    def open(self):
+        if self.member:
+            return ZipFile(self.path, 'r').open(self.member)
+        if self.path.lower().endswith('.gz'):
+            return gzip.open(self.path, 'rb')
+        return open(self.path, 'rb')
+
+    def seekable(self):
+        return self.sheet is None and not self.member and not self.path.lower().endswith('.gz')
+
+    def ogr_path(self):
+        if self.member:
+            return '/vsizip/' + os.path.abspath(self.path) + '/' + self.member
+        if self.path.lower().endswith('.gz'):
+            return '/vsigzip/' + os.path.abspath(self.path)
+        return self.path
+
+
+class StreamSource:
+    """
+    A download that is read as it arrives, in place of a SourceFile. A thread moves the response into a
+    bounded queue so the download runs at most queue_size chunks ahead of the parser and waits whenever the
+    parser falls behind. Gzipped responses are decompressed as they are read.
+    """
+
+    def __init__(self, response, name, chunk_size=1048576, queue_size=8, gzipped=False):
+        self.response = response
+        self.name = name
+        self.path = None
+        self.member = None
+        self.sheet = None
+        self.chunk_size = chunk_size
+        self.content_hash = hashlib.sha256()
+        self.size = 0
+        self.error = None
+        self.buffer = ''
+        self.position = 0
+        self.finished = False
+        self.gzipped = gzipped
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self.queue = Queue.Queue(max(queue_size, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.download)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def download(self):
+        try:
+            for chunk in self.response.iter_content(chunk_size=self.chunk_size):
+                if chunk:
+                    self.content_hash.update(chunk)
+                    self.size += len(chunk)
+                    if not self.put(chunk):
+                        return
+            total_size = self.response.headers.get('content-length')
+            # iter_content decodes compressed responses so only identity transfers can be compared to content-length.
+            if total_size and not self.response.headers.get('content-encoding') and self.size < int(total_size):
+                self.error = IOError("The download ended after " + str(self.size) + " of " + total_size + " bytes.")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.response.close()
+            self.put(None)
+
+    def put(self, chunk):
+        # the parser may stop early, so the download gives up instead of waiting on a full queue forever.
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(chunk, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def next_chunk(self):
+        if self.finished:
+            return ''
+        chunk = self.queue.get()
+        if chunk is None:
+            self.finished = True
+            if self.error:
+                raise IOError(str(self.error))
+            return self.decompressor.flush() if self.decompressor else ''
+        if not self.decompressor:
+            return chunk
+        data = self.decompressor.decompress(chunk)
+        # a gzip file may hold several members one after the other.
+        while self.decompressor.unused_data:
+            unused_data = self.decompressor.unused_data
+            data += self.decompressor.flush()
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += self.decompressor.decompress(unused_data)
+        return data
+
+    def fill(self, size=None, until=None):
+        search = self.position
+        while not self.finished and (size is None or len(self.buffer) - self.position < size) and \
+                (until is None or self.buffer.find(until, search) == -1):
+            # reads only move the position, the consumed data is dropped once per chunk.
+            search = len(self.buffer) - self.position
+            self.buffer = self.buffer[self.position:] + self.next_chunk()
+            self.position = 0
+
+    def read(self, size=-1):
+        self.fill(size if size >= 0 else None)
+        end = len(self.buffer) if size < 0 else min(self.position + size, len(self.buffer))
+        data = self.buffer[self.position:end]
+        self.position = end
+        return data
+
+    def readline(self):
+        self.fill(until='\n')
+        end = self.buffer.find('\n', self.position) + 1 or len(self.buffer)
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def peek(self, size):
+        self.fill(size)
+        return self.buffer[self.position:self.position + size]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def detect_encoding(self, sample_size=65536):
+        # the stream can't be read a second time, so it is read as utf-8 if the sample doesn't tell.
+        return detect_encoding(StringIO(self.peek(sample_size)), sample_size).get('encoding') or 'utf-8'
+
+    def open(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def split_csv(file_path, start, range_size):
+    """
+    Splits a csv file into ranges of roughly range_size bytes that each end with a line break outside of a
+    quoted field, so fields spanning several lines stay in one range.
+    :param file_path: The csv file.
+    :param start: The offset of the first row after the header.
+    :param range_size: The number of bytes in each range.
+    :return: A list of (start, end) offsets, or None if the file ends inside a quoted field.
+    """
+    boundaries = [start]
+    target = start + range_size
+    offset = start
+    # whether the position counted up to is inside quotes, an escaped "" flips it twice.
+    quoted = False
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(start)
+        while True:
+            block = csv_file.read(range_size)
+            if not block:
+                break
+            counted = 0
+            search = max(target - offset, 0)
+            while search < len(block):
+                newline = block.find('\n', search)
+                if newline == -1:
+                    break
+                quoted ^= block.count('"', counted, newline) % 2 == 1
+                counted = newline
+                if quoted:
+                    search = newline + 1
+                    continue
+                boundaries.append(offset + newline + 1)
+                target = offset + newline + 1 + range_size
+                search = max(target - offset, newline + 1)
+            quoted ^= block.count('"', counted) % 2 == 1
+            offset += len(block)
+    # an odd number of quotes means a stray one, where quoted fields can't be told apart.
+    if quoted:
+        return None
+    if boundaries[-1] < offset:
+        boundaries.append(offset)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def parse_csv_range(arguments):
+    file_path, start, end, header_row, delimiter = arguments
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(start)
+        data = csv_file.read(end - start)
+    return list(csv.DictReader(StringIO(data), header_row, delimiter=delimiter))
+
+
+def iter_parallel_csv(file_path, start, header_row, delimiter, processes=2, range_size=16777216):
+    """
+    :param file_path: The csv or tsv file.
+    :param start: The offset of the first row after the header.
+    :param header_row: The column names.
+    :param delimiter: The delimiter sniffed from the header.
+    :param processes: The number of processes parsing ranges at once.
+    :param range_size: The number of bytes each process parses at a time.
+    :return: A generator of the rows of the file as dicts, in order.
+    """
+    ranges = split_csv(file_path, start, range_size)
+    if not ranges or len(ranges) < 2:
+        if ranges is None:
+            print file_path + " has an unmatched quote so it is parsed in one process."
+        with open(file_path, 'rb') as csv_file:
+            csv_file.seek(start)
+            for row in csv.DictReader(csv_file, header_row, delimiter=delimiter):
+                yield row
+        return
+    print "Parsing " + str(len(ranges)) + " ranges of " + file_path + " with " + str(processes) + " processes."
+    pool = multiprocessing.Pool(processes)
+    tasks = iter([(file_path, range_start, range_end, header_row, delimiter) for range_start, range_end in ranges])
+    # at most two ranges per process are parsed ahead of the rows being consumed.
+    pending = [pool.apply_async(parse_csv_range, (task,)) for task in itertools.islice(tasks, 2 * processes)]
+    try:
+        while pending:
+            rows = pending.pop(0).get()
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(parse_csv_range, (task,)))
+            for row in rows:
+                yield row
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# common layouts of dates in tabular sources, the first that parses every sampled value of a column is used.
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%SZ', '%Y/%m/%d',
+                '%m/%d/%Y', '%Y%m%d']
+LATITUDE_NAMES = ['lat', 'latitude', 'latitude_deg', 'lat_deg', 'y']
+LONGITUDE_NAMES = ['lon', 'lng', 'long', 'longitude', 'longitude_deg', 'lon_deg', 'x']
+INTEGER_PATTERN = re.compile(r'^[-+]?(0|[1-9][0-9]*)$')
+FLOAT_PATTERN = re.compile(r'^[-+]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?$')
+
+
+def value_type(value):
+    """
+    :return: The narrowest of int, float, bool or string a value reads as, None if it is empty.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, long)):
+        return 'int'
+    if isinstance(value, float):
+        return 'int' if value.is_integer() and abs(value) < 2 ** 53 else 'float'
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return 'date'
+    value = value.strip()
+    # identifiers with leading zeros and values mongo can't hold as a long stay strings.
+    if INTEGER_PATTERN.match(value) and abs(int(value)) < 2 ** 63:
+        return 'int'
+    if FLOAT_PATTERN.match(value):
+        return 'float'
+    if value.lower() in ['true', 'false']:
+        return 'bool'
+    return 'string'
 
 
-def read_line_number(input_file, line):
-    i = 0
-    input_file.seek(0)
-    while i < line:
-        input_file.readline()
-        i += 1
-    return input_file.readline()
+def date_format(values):
+    """
+    :return: The first of DATE_FORMATS that parses all the values, or None.
+    """
+    for layout in DATE_FORMATS:
+        try:
+            for value in values:
+                datetime.datetime.strptime(value.strip(), layout)
+            return layout
+        except (ValueError, AttributeError):
+            continue
+    return None
+
+
+def infer_schema(rows, key_fields=None):
+    """
+    :param rows: A sample of rows as dicts.
+    :param key_fields: Columns that are always left as strings.
+    :return: A dict with 'fields', a [name, type, date format] list for each column, and 'point', the
+             [longitude, latitude] columns if the rows hold coordinates. 'point_field' is the field the Point
+             is stored in, geometry unless the rows have a geometry column of their own, then dw_point.
+    """
+    key_fields = key_fields or []
+    columns = sorted(set(key for row in rows for key in row if key))
+    fields = []
+    for column in columns:
+        values = [row.get(column) for row in rows if row.get(column) is not None and row.get(column) != '']
+        types = set(value_type(value) for value in values)
+        layout = None
+        if column in key_fields or not types:
+            kind = 'string'
+        elif types <= set(['int']):
+            kind = 'int'
+        elif types <= set(['int', 'float']):
+            kind = 'float'
+        elif types == set(['bool']) or types == set(['date']):
+            kind = types.pop()
+        elif types == set(['string', 'int']) or types == set(['string']):
+            layout = date_format(values)
+            kind = 'date' if layout else 'string'
+        else:
+            kind = 'string'
+        fields.append([column, kind, layout])
+    schema = {'fields': fields, 'point': None}
+    numeric = dict((field[0].lower(), field[0]) for field in fields if field[1] in ['int', 'float'])
+    latitude = next((numeric[name] for name in LATITUDE_NAMES if name in numeric), None)
+    longitude = next((numeric[name] for name in LONGITUDE_NAMES if name in numeric), None)
+    if latitude and longitude:
+        in_range = all(-90 <= float(row.get(latitude)) <= 90 and -180 <= float(row.get(longitude)) <= 180
+                       for row in rows if row.get(latitude) not in [None, ''] and row.get(longitude) not in [None, ''])
+        if in_range:
+            schema['point'] = [longitude, latitude]
+            has_geometry = any(row.get('geometry') not in [None, ''] for row in rows)
+            schema['point_field'] = 'dw_point' if has_geometry else 'geometry'
+    return schema
+
+
+def value_converter(kind, layout=None):
+    """
+    :return: A function converting a value to kind, values that don't convert are returned as they are.
+    """
+    if kind == 'int':
+        convert = lambda value: int(float(value)) if isinstance(value, float) else int(value)
+    elif kind == 'float':
+        convert = float
+    elif kind == 'bool':
+        convert = lambda value: value if isinstance(value, bool) else value.strip().lower() == 'true'
+    elif kind == 'date':
+        convert = lambda value: value if isinstance(value, datetime.datetime) else \
+            datetime.datetime.strptime(value.strip(), layout)
+    else:
+        return None
+
+    def converter(value):
+        if value is None or value == '':
+            return None
+        try:
+            return convert(value)
+        except (ValueError, TypeError, AttributeError):
+            return value
+    return converter
+
+
+def convert_rows(rows, schema):
+    """
+    Converts a batch of rows one column at a time.
+    :param rows: The rows as dicts, they are changed in place.
+    :param schema: A schema from infer_schema.
+    :return: The rows.
+    """
+    for column, kind, layout in schema.get('fields'):
+        converter = value_converter(kind, layout)
+        if not converter:
+            continue
+        for row, value in zip(rows, map(converter, [row.get(column) for row in rows])):
+            if column in row:
+                row[column] = value
+    if schema.get('point'):
+        longitude, latitude = schema.get('point')
+        point_field = schema.get('point_field') or 'geometry'
+        for row in rows:
+            lon = row.get(longitude)
+            lat = row.get(latitude)
+            # a value the source has in the field is never replaced.
+            if row.get(point_field) not in [None, '']:
+                continue
+            if isinstance(lon, (int, long, float)) and isinstance(lat, (int, long, float)) and \
+                    -180 <= lon <= 180 and -90 <= lat <= 90:
+                row[point_field] = {'type': 'Point', 'coordinates': [float(lon), float(lat)]}
+    return rows
+
+
+def iter_excel_rows(file_path, sheet_name, header=None):
+    """
+    :param file_path: An xls or xlsx workbook.
+    :param sheet_name: The sheet to read, only this sheet is loaded.
+    :param header: The row that holds the column names, as with csv files.
+    :return: A generator of a dict for each row after the header.
+    """
+    try:
+        header = int(header)
+    except:
+        header = 0
+    openpyxl = lazy_import('openpyxl', required=False)
+    if openpyxl and file_path.lower().endswith('.xlsx'):
+        book = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        rows = ([cell.value for cell in row] for row in book[sheet_name].iter_rows())
+    else:
+        book = lazy_import('xlrd').open_workbook(file_path, on_demand=True)
+        sheet = book.sheet_by_name(sheet_name)
+        rows = (sheet.row_values(row_num) for row_num in xrange(sheet.nrows))
+    try:
+        header_row = None
+        for row_num, row in enumerate(rows):
+            if row_num < header:
+                continue
+            if header_row is None:
+                header_row = [unicode(value) if value is not None else u'' for value in row]
+                print "Header detected as: " + str(header_row)
+                continue
+            # blank rows are skipped like csv.DictReader does.
+            if all(value is None or value == '' for value in row):
+                continue
+            yield dict(zip(header_row, row))
+    finally:
+        if hasattr(book, 'release_resources'):
+            book.release_resources()
+        elif hasattr(book, 'close'):
+            book.close()
+
+
+class JSONStream:
+    """
+    Decodes JSON values from a file one at a time, reading only as much of the file as each value needs.
+    """
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, data_file, chunk_size=1048576):
+        self.data_file = data_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def fill(self):
+        # values larger than the buffer double the read size so that re-decoding them stays linear.
+        chunk = self.data_file.read(max(self.chunk_size, len(self.buffer) - self.position))
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.position = self.whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return None
+
+    def expect(self, token):
+        if self.peek() != token:
+            raise ValueError("Expected '{}' but found '{}'.".format(token, self.peek()))
+        self.position += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # a number at the end of the buffer may continue in the next chunk.
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self.decode()
+            token = self.peek()
+            self.position += 1
+            if token == ']':
+                return
+            elif token != ',':
+                raise ValueError("Expected ',' or ']' but found '{}'.".format(token))
+
+
+def iter_json_documents(data_file, encoding=None, chunk_size=1048576):
+    """
+    :param data_file: An open JSON file.
+    :param encoding: The encoding of the file if it isn't ascii or utf-8.
+    :param chunk_size: The number of bytes to read at a time.
+    :return: A generator of the features of a FeatureCollection, the elements of a top level array,
+    or otherwise the single value in the file.
+    """
+    if encoding and encoding.lower() not in ['ascii', 'utf-8']:
+        data_file = codecs.getreader(encoding)(data_file)
+    stream = JSONStream(data_file, chunk_size=chunk_size)
+    token = stream.peek()
+    if token == '[':
+        for element in stream.iter_array():
+            yield element
+    elif token == '{':
+        stream.expect('{')
+        members = {}
+        streamed = False
+        while stream.peek() != '}':
+            if stream.peek() == ',':
+                stream.expect(',')
+            key = stream.decode()
+            stream.expect(':')
+            if key == 'features' and stream.peek() == '[':
+                for feature in stream.iter_array():
+                    yield feature
+                streamed = True
+            else:
+                members[key] = stream.decode()
+        if not streamed:
+            yield members
+    elif token is not None:
+        yield stream.decode()
+
+
+def interleave_hosts(sources):
+    """
+    Orders sources round robin by host so a pool doesn't fill up with downloads waiting on one host.
+    """
+    by_host = {}
+    hosts = []
+    for source in sources:
+        host = urlparse.urlparse(source.get('data_url') or '').netloc
+        if host not in by_host:
+            by_host[host] = []
+            hosts.append(host)
+        by_host[host].append(source)
+    ordered = []
+    while hosts:
+        for host in list(hosts):
+            ordered.append(by_host[host].pop(0))
+            if not by_host[host]:
+                hosts.remove(host)
+    return ordered
+
+
+def print_timings(timings, total):
+    for name in sorted(timings):
+        print("{}: download {:.2f}s, import {:.2f}s".format(name,
+                                                          timings[name].get('download', 0),
+                                                          timings[name].get('import', 0)))
+    print("Refreshed {} sources in {:.2f}s.".format(len(timings), total))
+
+
+def iter_ogr_features(file_path, format):
+    """
+    :param file_path: A file OGR can open.
+    :param format: The name of the OGR driver to open it with.
+    :return: A generator of the GeoJSON features of every layer, one at a time.
+    """
+    driver = lazy_import('osgeo.ogr').GetDriverByName(format)
+    driver_source = driver.Open(file_path)
+    if driver_source is None:
+        print "OGR was unable to open " + file_path
+        return
+    for layer in driver_source:
+        for feature in layer:
+            yield feature.ExportToJson(as_object=True)
+
+
+def copy_ogr_layers(file_path, format, output_path, driver_name):
+    """
+    Copies every layer of a file with OGR, which streams the features and builds each layer's spatial index.
+    The first layer is named after output_path, as GeoServer names the layer it imports, and the others are
+    suffixed with their own names.
+    :param file_path: A file OGR can open.
+    :param format: The name of the OGR driver to open it with.
+    :param output_path: The file to write, it is only renamed into place once it is complete.
+    :param driver_name: The OGR driver to write it with, like 'GPKG' or 'FlatGeobuf'.
+    :return: True if the layers were copied.
+    """
+    ogr = lazy_import('osgeo.ogr')
+    driver = ogr.GetDriverByName(driver_name)
+    if driver is None:
+        print "This version of GDAL can't write " + driver_name + "."
+        return False
+    driver_source = ogr.GetDriverByName(format).Open(file_path)
+    if driver_source is None:
+        print "OGR was unable to open " + file_path
+        return False
+    layer_count = driver_source.GetLayerCount()
+    if driver_name == 'FlatGeobuf' and layer_count > 1:
+        print "A FlatGeobuf file holds one layer but " + file_path + " has " + str(layer_count) + "."
+        return False
+    # drivers choose what to write from the extension, so it is kept on the partial file.
+    root, extension = os.path.splitext(output_path)
+    part_path = root + '.part' + extension
+    if os.path.exists(part_path):
+        driver.DeleteDataSource(part_path)
+    output = driver.CreateDataSource(part_path)
+    if output is None:
+        print "OGR was unable to create " + part_path
+        return False
+    name = os.path.splitext(os.path.basename(output_path))[0]
+    for index in range(layer_count):
+        layer = driver_source.GetLayer(index)
+        layer_name = name if index == 0 else name + '_' + layer.GetName()
+        if output.CopyLayer(layer, layer_name, ['SPATIAL_INDEX=YES']) is None:
+            print "OGR was unable to copy the " + layer.GetName() + " layer of " + file_path
+            output = None
+            driver.DeleteDataSource(part_path)
+            return False
+    # the data and its index are only flushed once the datasource is released.
+    output = None
+    driver_source = None
+    if os.path.isfile(output_path):
+        os.remove(output_path)
+    os.rename(part_path, output_path)
+    return True
+
+
+def write_geojson(features, json_path, ndjson=False):
+    """
+    Writes features to json_path as they pass through, either as a FeatureCollection or one feature per line.
+    :param features: An iterable of GeoJSON features.
+    :param json_path: The file to write.
+    :param ndjson: Whether to write newline delimited features instead of a FeatureCollection.
+    :return: A generator of the same features.
+    """
+    part_path = json_path + '.part'
+    with open(part_path, 'w') as json_file:
+        if not ndjson:
+            json_file.write('{"type": "FeatureCollection", "features": [')
+        separator = '' if ndjson else '\n'
+        for feature in features:
+            json_file.write(separator)
+            json.dump(feature, json_file)
+            if ndjson:
+                json_file.write('\n')
+            else:
+                separator = ',\n'
+            yield feature
+        if not ndjson:
+            json_file.write('\n]}')
+    if os.path.isfile(json_path):
+        os.remove(json_path)
+    os.rename(part_path, json_path)
+
+
+def bbox_polygon(bbox):
+    """
+    :param bbox: [west, south, east, north]
+    :return: The GeoJSON Polygon of the box.
+    """
+    west, south, east, north = [float(value) for value in bbox]
+    return {'type': 'Polygon',
+            'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def feature_parts(document, geometry_field='geometry'):
+    """
+    :param document: A GeoJSON feature as imported from a spatial source, or a flat row.
+    :param geometry_field: The field holding the geometry to export.
+    :return: The properties, geometry and bbox of the document, without the fields derived from its geometry.
+    The fields of a flat row are all properties, even ones named geometry or properties, and geometry_field
+    is only the geometry if it holds a GeoJSON geometry.
+    """
+    is_feature = document.get('type') == 'Feature' and isinstance(document.get('properties'), dict)
+    properties = dict(document.get('properties')) if is_feature else {}
+    geometry = document.get(geometry_field)
+    if not (isinstance(geometry, dict) and geometry.get('type')):
+        geometry = None
+    for key, value in document.iteritems():
+        if key == geometry_field and geometry is not None:
+            continue
+        if key in ['dw_bbox', 'dw_centroid'] or key.startswith('dw_simplified_'):
+            continue
+        if is_feature and key in ['type', 'properties', 'geometry']:
+            continue
+        properties[key] = value
+    return properties, geometry, document.get('dw_bbox') if geometry else None
+
+
+def export_default(value):
+    # dates and ObjectIds are written as text.
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def write_export(documents, export_file, format, fields=None, geometry_field='geometry', sample_size=1000):
+    """
+    Writes documents to a file as they are read.
+    :param documents: An iterable of documents, like a cursor.
+    :param export_file: The open file to write to.
+    :param format: 'ndjson' writes one feature (or row without a geometry) per line, 'geojson' a FeatureCollection
+    and 'csv' a row per document with the geometry as GeoJSON.
+    :param fields: The csv columns, otherwise they are the properties of the first sample_size documents.
+    :return: The number of documents written.
+    """
+    count = 0
+    if format == 'csv':
+        documents = iter(documents)
+        sample = []
+        for document in documents:
+            sample.append(feature_parts(document, geometry_field))
+            if len(sample) >= sample_size:
+                break
+        if fields:
+            columns = list(fields)
+        else:
+            columns = sorted(set(key for properties, geometry, bbox in sample for key in properties))
+        # the geometry gets its own column, which is dw_geometry if the documents have a geometry field of their own.
+        geometry_column = 'geometry'
+        if any('geometry' in properties for properties, geometry, bbox in sample):
+            geometry_column = 'dw_geometry'
+        if any(geometry for properties, geometry, bbox in sample) and geometry_column not in columns:
+            columns.append(geometry_column)
+        writer = lazy_import('unicodecsv').writer(export_file, encoding='utf-8')
+        writer.writerow(columns)
+
+        def rows():
+            for parts in sample:
+                yield parts
+            for document in documents:
+                yield feature_parts(document, geometry_field)
+        for properties, geometry, bbox in rows():
+            values = []
+            for column in columns:
+                value = geometry if column == geometry_column else properties.get(column)
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value, default=export_default)
+                elif isinstance(value, (datetime.datetime, datetime.date)):
+                    value = value.isoformat()
+                values.append(value)
+            writer.writerow(values)
+            count += 1
+        return count
+    if format == 'geojson':
+        export_file.write('{"type": "FeatureCollection", "features": [')
+    separator = '\n'
+    for document in documents:
+        properties, geometry, bbox = feature_parts(document, geometry_field)
+        if geometry or format == 'geojson':
+            item = {'type': 'Feature', 'geometry': geometry, 'properties': properties}
+            if bbox:
+                item['bbox'] = bbox
+        else:
+            item = properties
+        if format == 'geojson':
+            export_file.write(separator)
+            separator = ',\n'
+        export_file.write(json.dumps(item, default=export_default))
+        if format == 'ndjson':
+            export_file.write('\n')
+        count += 1
+    if format == 'geojson':
+        export_file.write('\n]}\n')
+    return count
+
+
+def iter_converted_features(json_path):
+    """
+    :param json_path: A FeatureCollection or newline delimited features written by write_geojson, or a GeoPackage
+    or FlatGeobuf file written by copy_ogr_layers.
+    :return: A generator of the features.
+    """
+    driver_name = OGR_CONVERSION_DRIVERS.get(os.path.splitext(json_path)[1].lower().lstrip('.'))
+    if driver_name:
+        for feature in iter_ogr_features(json_path, driver_name):
+            yield feature
+        return
+    with open(json_path, 'rb') as json_file:
+        if json_path.lower().endswith('.ndjson'):
+            for line in json_file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for feature in iter_json_documents(json_file):
+                yield feature
+
+
+def newer(file_path, source_path):
+    """
+    :return: True if file_path exists and was written after source_path.
+    """
+    return os.path.isfile(file_path) and os.path.getmtime(file_path) >= os.path.getmtime(source_path)
+
+
+def lazy_import(name, required=True):
+    """
+    Imports a module the first time it is used, so importing database doesn't load GDAL, xlrd or chardet.
+    :param name: The module, like 'osgeo.ogr'.
+    :param required: Whether a missing module is an ImportError, otherwise None is returned.
+    """
+    if name not in LAZY_MODULES:
+        try:
+            LAZY_MODULES[name] = importlib.import_module(name)
+        except ImportError:
+            if required:
+                raise
+            LAZY_MODULES[name] = None
+    return LAZY_MODULES[name]
 
 
 def working_folder(file_path):
@@ -557,19 +2416,182 @@ def print_status(size, total_size):
     sys.stdout.write("[%-50s] %d%%, %d of %d" % ('='*int(percent/2), percent,size, total_size))
     sys.stdout.flush()
 
-#note that this resets the file cursor
-def detect_encoding(open_file):
-    detector = UniversalDetector()
-    for line in open_file.readlines():
-        detector.feed(line)
-        if detector.done: break
+#note that this consumes the file, archive members can't be rewound so open it again to read it.
+def detect_encoding(open_file, sample_size=65536, chunk_size=4096):
+    """
+    :param open_file: A file opened in binary mode.
+    :param sample_size: The most bytes to read before settling on the best guess so far.
+    :param chunk_size: The number of bytes fed to the detector at a time.
+    :return: The chardet result, a dict with the encoding and confidence.
+    """
+    detector = lazy_import('chardet.universaldetector').UniversalDetector()
+    read = 0
+    while read < sample_size and not detector.done:
+        chunk = open_file.read(min(chunk_size, sample_size - read))
+        if not chunk:
+            break
+        detector.feed(chunk)
+        read += len(chunk)
     detector.close()
-    open_file.seek(0)
     return detector.result
 
 
-def main():
-    print "database doesn't have a main method."
+def document_hash(document):
+    """
+    :return: A hash of a document's content ignoring _id and the dw_ fields the wrangler adds.
+    """
+    content = dict((key, value) for key, value in document.iteritems()
+                   if key != '_id' and not key.startswith('dw_'))
+    return hashlib.sha1(repr(canonical(content))).hexdigest()
+
+
+def canonical(value):
+    # dict items are sorted so that the same content always has the same repr.
+    if isinstance(value, dict):
+        return sorted((key, canonical(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def next_refresh(date, mag):
+    """
+    :param date: When the source was last refreshed, a datetime or a yyyymmddHHMMSS integer.
+    :param mag: The refresh_rate (0=second, 1=minute, 2=hour, 3=day, 4=month, 5=year, 6=century).
+    :return: The datetime the source is next due, or None if it never is.
+    """
+    if not mag and mag != 0:
+        mag = 7
+    mag = int(float(mag))
+    if not isinstance(date, datetime.datetime):
+        try:
+            date = datetime.datetime.strptime(str(long(date)), '%Y%m%d%H%M%S')
+        except (TypeError, ValueError):
+            # sources that were never refreshed are due straight away.
+            return datetime.datetime(1970, 1, 1)
+    if mag < 4:
+        return date + datetime.timedelta(seconds=[1, 60, 3600, 86400][max(mag, 0)])
+    months = 1 if mag == 4 else 12 * int(math.pow(100, mag - 5))
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    if year > datetime.MAXYEAR:
+        return None
+    month = month % 12 + 1
+    return date.replace(year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def timestamp(date):
+    return time.mktime(date.timetuple())
+
+
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return '{}-{}'.format(stat.st_size, int(stat.st_mtime))
+
+
+def print_plan(entries):
+    print "{:<30} {:<16} {:<5} {:<20} {:<16} {:>12}".format('import_name', 'data_format', 'due', 'next refresh',
+                                                          'status', 'bytes')
+    for entry in sorted(entries, key=lambda entry: entry.get('import_name')):
+        print "{:<30} {:<16} {:<5} {:<20} {:<16} {:>12}".format(
+            entry.get('import_name'), entry.get('data_format'), 'yes' if entry.get('due') else 'no',
+            '{:%Y-%m-%d %H:%M:%S}'.format(entry['next_refresh']) if entry.get('next_refresh') else 'never',
+            entry.get('status') or '-',
+            entry.get('content_length') if entry.get('content_length') is not None else '-')
+    due = [entry for entry in entries if entry.get('due')]
+    unknown = [entry for entry in due if entry.get('content_length') is None]
+    total = sum(entry.get('content_length') or 0 for entry in due)
+    print("{} of {} sources are due, about {:.1f} MB to download ({} of unknown size).".format(
+        len(due), len(entries), total / 1048576.0, len(unknown)))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Keeps MongoDB collections up to date with their data sources.")
+    parser.add_argument('--host', default='127.0.0.1', help="The mongod host.")
+    parser.add_argument('--port', type=int, default=27017, help="The mongod port.")
+    parser.add_argument('--database', default='geodata')
+    parser.add_argument('--temp-dir', default='./DataSources', help="Where downloads are kept.")
+    parser.add_argument('--workers', type=int, default=1, help="The number of sources handled at once.")
+    subparsers = parser.add_subparsers(dest='command')
+    sync_parser = subparsers.add_parser('sync-sources', help="Upserts a sources csv into data_sources.")
+    sync_parser.add_argument('csv_file', nargs='?',
+                             default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Sources.csv'))
+    refresh_parser = subparsers.add_parser('refresh', help="Downloads and imports the sources that are due.")
+    refresh_parser.add_argument('sources', nargs='*', help="Only refresh these import_names.")
+    refresh_parser.add_argument('--force', action='store_true', help="Refresh the sources even if they aren't due.")
+    refresh_parser.add_argument('--streaming', action='store_true', help="Load sources as they download.")
+    refresh_parser.add_argument('--watch', action='store_true', help="Keep refreshing sources as they come due.")
+    upload_parser = subparsers.add_parser('upload', help="Imports the sources' files into GeoServer.")
+    upload_parser.add_argument('sources', nargs='*', help="Only upload these import_names.")
+    upload_parser.add_argument('--geoserver-host', default='127.0.0.1')
+    upload_parser.add_argument('--geoserver-port', default='8080')
+    upload_parser.add_argument('--workspace', default='sde')
+    upload_parser.add_argument('--store', default='imports')
+    upload_parser.add_argument('--username')
+    upload_parser.add_argument('--password')
+    upload_parser.add_argument('--file', action='append', dest='files', default=[],
+                               help="Also upload this file, like an export, it can be given more than once.")
+    upload_parser.add_argument('--skip-existing', action='store_true', help="Skip files whose layer already exists.")
+    export_parser = subparsers.add_parser('export', help="Writes a collection to NDJSON, GeoJSON or CSV.")
+    export_parser.add_argument('collection')
+    export_parser.add_argument('file_path', help="The file to write, .gz is gzipped and .zip is zipped for GeoServer.")
+    export_parser.add_argument('--format', choices=['ndjson', 'geojson', 'csv'],
+                               help="Taken from the extension of file_path by default.")
+    export_parser.add_argument('--fields', help="Comma separated fields to export.")
+    export_parser.add_argument('--query', help="A mongo query as json.")
+    export_parser.add_argument('--bbox', help="west,south,east,north")
+    export_parser.add_argument('--geometry-field', default='geometry', help="Like dw_simplified_0_01.")
+    export_parser.add_argument('--batch-size', type=int, default=10000)
+    plan_parser = subparsers.add_parser('plan', help="Lists what a refresh would download, without changing anything.")
+    plan_parser.add_argument('sources', nargs='*', help="Only plan these import_names.")
+    plan_parser.add_argument('--no-head', action='store_true', help="Skip the HEAD requests for transfer sizes.")
+    options = parser.parse_args(args)
+
+    db = DB(host=options.host,
+            port=options.port,
+            database=options.database,
+            temp_dir=options.temp_dir,
+            workers=options.workers,
+            streaming=getattr(options, 'streaming', False))
+    if options.command == 'sync-sources':
+        db.sync_sources(options.csv_file)
+    elif options.command == 'refresh':
+        if not os.path.isdir(options.temp_dir):
+            os.makedirs(options.temp_dir)
+        if options.watch:
+            db.run_scheduler()
+        else:
+            db.update_data(import_names=options.sources or None, force=options.force)
+    elif options.command == 'upload':
+        file_names = [os.path.abspath(file_name) for file_name in options.files]
+        if options.sources or not file_names:
+            query = {'import_name': {'$in': options.sources}} if options.sources else {}
+            for source in db.database.data_sources.find(query):
+                file_names += source.get('local_file_path') or []
+        if not file_names:
+            print "There are no imported files to upload."
+            return
+        results = db.upload_to_geoserver(host=options.geoserver_host,
+                                         port=options.geoserver_port,
+                                         workspace=options.workspace,
+                                         targetStore=options.store,
+                                         source=file_names,
+                                         username=options.username,
+                                         password=options.password,
+                                         skip_existing=options.skip_existing)
+        for result in results:
+            print "{file}: {state} in {seconds:.1f}s".format(**result)
+    elif options.command == 'plan':
+        print_plan(db.plan(options.sources or None, head=not options.no_head))
+    elif options.command == 'export':
+        db.export(options.collection,
+                  options.file_path,
+                  format=options.format,
+                  fields=[field.strip() for field in options.fields.split(',')] if options.fields else None,
+                  query=json.loads(options.query) if options.query else None,
+                  bbox=[float(value) for value in options.bbox.split(',')] if options.bbox else None,
+                  geometry_field=options.geometry_field,
+                  batch_size=options.batch_size)
 
 
 if __name__ == "__main__":
@@ -3,32 +3,33 @@ import database
 
 def main():
 
-    ##run once using a CSV
-    db = database.DB(host='localhost',port=27017, database='geodata', csv_file='./Sources.csv')
+    db = database.DB(host='localhost',port=27017, database='geodata')
 
-    ##subsequent runs without a CSV will use the data that exists.
-    # db = database.DB(host='localhost',port=27017, database='geodata')
+    ##run once using a CSV, subsequent runs will use the sources that exist.
+    db.sync_sources('./Sources.csv')
+    db.update_data()
 
     sources = db.database.data_sources.find()
+    file_names = []
     for source in sources:
-        file_names = source.get('local_file_path')
-        if file_names:
-            for file_name in file_names:
-                print "Uploading the file: " + file_name
-                db.upload_to_geoserver(host='192.168.20.20',
-                                       port=8080,
-                                       workspace='sde',
-                                       targetStore='imports',
-                                       source=file_name,
-                                       username='admin',
-                                       password='geoserver')
+        file_names += source.get('local_file_path') or []
+    if file_names:
+        print "Uploading the files: " + ", ".join(file_names)
+        results = db.upload_to_geoserver(host='192.168.20.20',
+                                         port=8080,
+                                         workspace='sde',
+                                         targetStore='imports',
+                                         source=file_names,
+                                         username='admin',
+                                         password='geoserver')
+        for result in results:
+            print "{file}: {state} in {seconds:.1f}s".format(**result)
 
 if __name__ == "__main__":
     main()
 
-## example code for using pymongo to read collections.
-import pymongo
-client = pymongo.MongoClient('localhost',27017)
-db = client.geodata
-sources = db.data_sources.find()
-print sources[0]
+## example code for reading collections back out, without a pymongo cursor loop.
+## A .zip export holds GeoJSON that can be given to upload_to_geoserver.
+db = database.DB(host='localhost',port=27017, database='geodata')
+db.export('data_sources', './data_sources.csv')
+# db.export('ourairports', './ourairports.ndjson.gz', fields=['ident', 'name', 'iso_country'], bbox=[88, 20, 93, 27])
@@ -0,0 +1,122 @@
+import json
+import threading
+
+
+class GeometryEnricher:
+    """
+    Stores a bounding box (dw_bbox), a centroid (dw_centroid) and simplified copies of each feature's geometry
+    next to it, so bbox filters and map previews don't have to read every vertex. The geometries are handled
+    by OGR, without GDAL only the bounding boxes are computed. One enricher is shared by the files of an import
+    and keeps the extent of every feature it has seen.
+    """
+
+    def __init__(self, tolerances=None, field='geometry', ogr=None):
+        """
+        :param tolerances: The tolerances, in the units of the coordinates, to simplify geometries with. Each is
+        stored in its own field, see simplified_field. Geometries aren't simplified without any.
+        :param field: The field holding GeoJSON geometries.
+        :param ogr: The osgeo.ogr module, only bounding boxes are computed without it.
+        """
+        self.tolerances = sorted(tolerances or [])
+        self.field = field
+        self.count = 0
+        self.extent = None
+        self.lock = threading.Lock()
+        self.ogr = ogr
+
+    def enrich(self, documents):
+        """
+        :param documents: GeoJSON features or documents with a geometry, others are passed through.
+        :return: A generator of the same documents.
+        """
+        count = 0
+        extent = None
+        try:
+            for document in documents:
+                geometry = document.get(self.field)
+                if isinstance(geometry, dict) and (geometry.get('coordinates') or geometry.get('geometries')):
+                    bbox = self.add_summaries(document, geometry)
+                    if bbox:
+                        count += 1
+                        extent = merge_bbox(extent, bbox)
+                yield document
+        finally:
+            with self.lock:
+                self.count += count
+                self.extent = merge_bbox(self.extent, extent)
+
+    def add_summaries(self, document, geometry):
+        """
+        :return: The bbox set on the document, or None if the geometry has no coordinates.
+        """
+        ogr_geometry = None
+        if self.ogr:
+            ogr_geometry = self.ogr.CreateGeometryFromJson(json.dumps(geometry))
+            if ogr_geometry is not None and ogr_geometry.IsEmpty():
+                return None
+        if ogr_geometry is None:
+            bbox = geometry_bbox(geometry)
+            if bbox:
+                document['dw_bbox'] = bbox
+            return bbox
+        # OGR's envelope is (min x, max x, min y, max y), the GeoJSON bbox order is west, south, east, north.
+        min_x, max_x, min_y, max_y = ogr_geometry.GetEnvelope()
+        bbox = [min_x, min_y, max_x, max_y]
+        document['dw_bbox'] = bbox
+        if geometry.get('type') == 'Point':
+            document['dw_centroid'] = {'type': 'Point', 'coordinates': geometry.get('coordinates')[:2]}
+            return bbox
+        centroid = ogr_geometry.Centroid()
+        if centroid is not None and not centroid.IsEmpty():
+            document['dw_centroid'] = {'type': 'Point', 'coordinates': [centroid.GetX(), centroid.GetY()]}
+        if geometry.get('type') != 'MultiPoint':
+            for tolerance in self.tolerances:
+                simplified = ogr_geometry.SimplifyPreserveTopology(tolerance)
+                if simplified is not None and not simplified.IsEmpty():
+                    document[simplified_field(tolerance)] = json.loads(simplified.ExportToJson())
+        return bbox
+
+
+def simplified_field(tolerance):
+    """
+    :return: The field a geometry simplified with tolerance is stored in, like dw_simplified_0_001 for 0.001.
+    """
+    return 'dw_simplified_' + '{:g}'.format(tolerance).replace('.', '_')
+
+
+def geometry_bbox(geometry):
+    """
+    :return: The [west, south, east, north] of a GeoJSON geometry, or None if it has no positions.
+    """
+    if geometry.get('type') == 'GeometryCollection':
+        bbox = None
+        for part in geometry.get('geometries') or []:
+            bbox = merge_bbox(bbox, geometry_bbox(part))
+        return bbox
+    return coordinates_bbox(geometry.get('coordinates'))
+
+
+def coordinates_bbox(coordinates):
+    """
+    :param coordinates: The coordinates of a GeoJSON geometry, nested to any depth.
+    :return: [west, south, east, north], or None if there are no positions.
+    """
+    if not coordinates:
+        return None
+    if not isinstance(coordinates[0], (list, tuple)):
+        return [coordinates[0], coordinates[1], coordinates[0], coordinates[1]]
+    bbox = None
+    for part in coordinates:
+        bbox = merge_bbox(bbox, coordinates_bbox(part))
+    return bbox
+
+
+def merge_bbox(bbox, other):
+    """
+    :return: The bbox covering both, either may be None.
+    """
+    if not bbox:
+        return other
+    if not other:
+        return bbox
+    return [min(bbox[0], other[0]), min(bbox[1], other[1]), max(bbox[2], other[2]), max(bbox[3], other[3])]
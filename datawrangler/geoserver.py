@@ -0,0 +1,286 @@
+import os
+import time
+import getpass
+import threading
+import requests
+from multiprocessing.pool import ThreadPool
+
+# importer tasks in any other state won't change without another request.
+ACTIVE_STATES = ['READY', 'RUNNING', 'INIT']
+# tasks that are waiting on a fix, like a projection or bounds, before they can run.
+ATTENTION_STATES = ['PENDING', 'NO_CRS', 'NO_BOUNDS']
+
+
+class GeoServer:
+    """
+    A client for the GeoServer importer extension. One pooled session is used for every request, the
+    existence of workspaces, stores and layers is looked up once, and the files of an upload are grouped
+    into importer contexts that are submitted at the same time and polled until their tasks finish.
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port='8080',
+                 workspace=None,
+                 store=None,
+                 username=None,
+                 password=None,
+                 protocol=None,
+                 workers=4,
+                 group_size=10,
+                 poll_interval=1,
+                 max_poll_interval=30,
+                 timeout=3600,
+                 verify=False,
+                 skip_existing=False):
+        """
+        :param skip_existing: True to leave layers that already exist alone instead of importing their files again.
+        """
+        if not protocol:
+            protocol = 'https' if '443' in str(port) else 'http'
+        self.url = '{}://{}:{}/geoserver/rest'.format(protocol, host, port)
+        self.host = host
+        self.port = port
+        self.workspace = workspace
+        self.store = store
+        self.workers = workers
+        self.group_size = group_size
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.skip_existing = skip_existing
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max(workers, 10), pool_maxsize=max(workers, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.verify = verify
+        self.session.auth = requests.auth.HTTPBasicAuth(username, password) if username is not None else None
+        self.exists = {}
+        self.lock = threading.Lock()
+        self.auth_lock = threading.Lock()
+
+    def request(self, method, path, **kwargs):
+        """
+        :param method: The HTTP method.
+        :param path: A path under /geoserver/rest or a full url.
+        :return: The response, the credentials are asked for once if GeoServer refuses the request.
+        """
+        url = path if '://' in path else self.url + path
+        r = self.session.request(method, url, **kwargs)
+        if r.status_code == 401:
+            with self.auth_lock:
+                if self.session.auth is None:
+                    username = raw_input("Enter geoserver username:")
+                    password = getpass.getpass("Enter geoserver password:")
+                    self.session.auth = requests.auth.HTTPBasicAuth(username, password)
+            r = self.session.request(method, url, **kwargs)
+        return r
+
+    def resource_exists(self, path):
+        """
+        :param path: The REST path of a workspace, store or layer.
+        :return: True if it exists, each path is only requested once.
+        """
+        with self.lock:
+            if path in self.exists:
+                return self.exists[path]
+        exists = self.request('GET', path).status_code == 200
+        with self.lock:
+            self.exists[path] = exists
+        return exists
+
+    def layer_exists(self, name):
+        return self.resource_exists('/layers/{}.json'.format(name))
+
+    def ensure_store(self):
+        """
+        Creates the target PostGIS store if it doesn't exist yet.
+        :return: True if the store exists.
+        """
+        if not self.workspace or not self.store:
+            return True
+        store_path = '/workspaces/{}/datastores/{}.json'.format(self.workspace, self.store)
+        if self.resource_exists(store_path):
+            return True
+        print "The target store does not exist"
+        r = self.request('POST', '/workspaces/{}/datastores'.format(self.workspace),
+                         json=postgis_store(self.workspace, self.store, self.url))
+        if r.status_code != 201:
+            print "Unable to create the " + self.store + " datastore: " + r.text
+            return False
+        print "A datastore was successfully created."
+        with self.lock:
+            self.exists[store_path] = True
+        return True
+
+    def upload(self, file_paths):
+        """
+        :param file_paths: The paths of the files on the GeoServer host to import.
+        :return: A list of dicts with the file, import, task, state, layer and the seconds each task took.
+        """
+        if type(file_paths) is not list:
+            file_paths = [file_paths]
+        results = []
+        new_files = []
+        for file_path in file_paths:
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            if self.layer_exists(name) and self.skip_existing:
+                print "The " + file_path + " service already exists, it is skipped."
+                results.append({'file': file_path, 'import': None, 'task': None, 'state': 'EXISTS',
+                                'layer': name, 'seconds': 0, 'error': None})
+            else:
+                if self.layer_exists(name):
+                    print "The " + file_path + " service already exists."
+                new_files.append(file_path)
+        if not new_files:
+            return results
+        if not self.ensure_store():
+            return results + [{'file': file_path, 'import': None, 'task': None, 'state': 'NO_STORE',
+                               'layer': None, 'seconds': 0, 'error': None} for file_path in new_files]
+        groups = [new_files[start:start + self.group_size] for start in range(0, len(new_files), self.group_size)]
+        if self.workers > 1 and len(groups) > 1:
+            pool = ThreadPool(min(self.workers, len(groups)))
+            try:
+                group_results = pool.map(self.import_group, groups, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            group_results = [self.import_group(group) for group in groups]
+        for group_result in group_results:
+            results += group_result
+        return results
+
+    def import_group(self, file_paths):
+        """
+        :param file_paths: The files to import in one importer context.
+        :return: The results of the context's tasks once none of them are active.
+        """
+        started = time.time()
+        payload = {'import': {}}
+        if self.workspace:
+            payload['import']['targetWorkspace'] = {'workspace': {'name': self.workspace}}
+        if self.store:
+            payload['import']['targetStore'] = {'dataStore': {'name': self.store}}
+        r = self.request('POST', '/imports', json=payload)
+        if r.status_code not in [200, 201]:
+            print "Unable to create an import: " + r.text
+            return [{'file': file_path, 'import': None, 'task': None, 'state': 'ERROR', 'layer': None,
+                     'seconds': time.time() - started, 'error': r.text} for file_path in file_paths]
+        import_id = r.json().get('import').get('id')
+        import_path = '/imports/{}'.format(import_id)
+
+        # tasks are added to the context at the same time, each file becomes one or more tasks.
+        def add_task(file_path):
+            task_r = self.request('POST', import_path + '/tasks', data={'url': 'file:' + file_path})
+            if task_r.status_code not in [200, 201]:
+                return file_path, [], task_r.text
+            body = task_r.json()
+            return file_path, body.get('tasks') or [body.get('task')], None
+        if self.workers > 1 and len(file_paths) > 1:
+            pool = ThreadPool(min(self.workers, len(file_paths)))
+            try:
+                added = pool.map(add_task, file_paths, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            added = [add_task(file_path) for file_path in file_paths]
+
+        results = []
+        task_files = {}
+        for file_path, tasks, error in added:
+            if not tasks:
+                print "The file: " + file_path + " was not a valid source."
+                results.append({'file': file_path, 'import': import_id, 'task': None, 'state': 'NO_FORMAT',
+                                'layer': None, 'seconds': time.time() - started, 'error': error})
+                continue
+            for task in tasks:
+                task_files[task.get('id')] = file_path
+                if task.get('state') == 'NO_CRS':
+                    self.request('PUT', '{}/tasks/{}/layer'.format(import_path, task.get('id')),
+                                 json={'layer': {'srs': 'EPSG:4326'}})
+        if not task_files:
+            return results
+
+        self.request('POST', import_path, params={'async': 'true'})
+        tasks = self.poll(import_path)
+        seconds = time.time() - started
+        for task in tasks:
+            task_id = task.get('id')
+            layer = task.get('layer') or {}
+            state = task.get('state')
+            if state == 'COMPLETE':
+                with self.lock:
+                    self.exists['/layers/{}.json'.format(layer.get('name'))] = True
+            if state in ATTENTION_STATES:
+                print "The " + str(task_files.get(task_id)) + " import task is " + str(state) + " and needs attention."
+            else:
+                print "The " + str(task_files.get(task_id)) + " import task is " + str(state) + "."
+            results.append({'file': task_files.get(task_id), 'import': import_id, 'task': task_id, 'state': state,
+                            'layer': layer.get('name'), 'seconds': seconds,
+                            'error': task.get('errorMessage')})
+        return results
+
+    def poll(self, import_path):
+        """
+        Polls an import with an exponential backoff until none of its tasks are active or the timeout passes.
+        :param import_path: The REST path of the import.
+        :return: The import's tasks as last read.
+        """
+        delay = self.poll_interval
+        deadline = time.time() + self.timeout
+        while True:
+            r = self.request('GET', import_path + '/tasks')
+            tasks = r.json().get('tasks', []) if r.status_code == 200 else []
+            if not any(task.get('state') in ACTIVE_STATES for task in tasks) or time.time() >= deadline:
+                return tasks
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, self.max_poll_interval)
+
+
+def postgis_store(workspace, store, url):
+    """
+    :return: The payload creating the PostGIS datastore the importer writes into.
+    """
+    return {
+        "dataStore": {
+            "name": store,
+            "type": "PostGIS",
+            "enabled": True,
+            "workspace": {
+                "name": workspace,
+                "href": "{}/workspaces/{}.json".format(url, workspace)
+            },
+            "connectionParameters": {
+                "entry": [{"@key": key, "$": value} for key, value in [
+                    ("schema", "public"),
+                    ("Evictor run periodicity", "300"),
+                    ("Max open prepared statements", "50"),
+                    ("encode functions", "false"),
+                    ("preparedStatements", "false"),
+                    ("database", "imports"),
+                    ("host", "localhost"),
+                    ("Loose bbox", "true"),
+                    ("Estimated extends", "true"),
+                    ("fetch size", "1000"),
+                    ("Expose primary keys", "false"),
+                    ("validate connections", "true"),
+                    ("Support on the fly geometry simplification", "true"),
+                    ("Connection timeout", "20"),
+                    ("create database", "false"),
+                    ("port", "5432"),
+                    ("passwd", "importer"),
+                    ("min connections", "1"),
+                    ("dbtype", "postgis"),
+                    ("namespace", "http://geoserver.sf.net"),
+                    ("max connections", "10"),
+                    ("Evictor tests per run", "3"),
+                    ("Test while idle", "true"),
+                    ("user", "importer"),
+                    ("Max connection idle time", "300")]]
+            },
+            "_default": False,
+            "featureTypes": "{}/workspaces/{}/datastores/{}/featuretypes.json".format(url, workspace, store)
+        }
+    }
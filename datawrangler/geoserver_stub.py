@@ -0,0 +1,110 @@
+"""
+A stub of the GeoServer importer REST API for test_geoserver.py and benchmark.py. It answers the requests the
+GeoServer client makes the way GeoServer does: imports run for one poll and then their tasks take the state
+final_states has for their layer, COMPLETE by default.
+"""
+import os
+import json
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+class ImporterHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        path = urlparse.urlparse(self.path).path.replace('/geoserver/rest', '').strip('/')
+        parts = path.split('/')
+        with server.lock:
+            server.requests.append((method, path))
+            if parts[0] == 'layers' and method == 'GET':
+                return self.reply(200 if os.path.splitext(parts[-1])[0] in server.layers else 404, {})
+            if parts[0] == 'workspaces' and method == 'GET':
+                return self.reply(200 if os.path.splitext(parts[-1])[0] in server.stores else 404, {})
+            if parts[0] == 'workspaces' and method == 'POST':
+                server.stores.add(json.loads(body).get('dataStore', {}).get('name'))
+                return self.reply(201)
+            if parts[0] != 'imports':
+                return self.reply(404, {})
+            if len(parts) == 1 and method == 'POST':
+                import_id = len(server.imports)
+                server.imports[import_id] = {'tasks': [], 'polls': 0}
+                return self.reply(201, {'import': {'id': import_id}})
+            context = server.imports.get(int(parts[1]))
+            if context is None:
+                return self.reply(404, {})
+            if len(parts) == 3 and method == 'POST':
+                file_path = urlparse.parse_qs(body).get('url', [''])[0]
+                task = {'id': len(context['tasks']), 'state': 'READY',
+                        'layer': {'name': os.path.splitext(os.path.basename(file_path))[0]}}
+                context['tasks'].append(task)
+                return self.reply(201, {'task': task})
+            if len(parts) == 2 and method == 'POST':
+                for task in context['tasks']:
+                    task['state'] = 'RUNNING'
+                return self.reply(204)
+            if len(parts) == 3 and method == 'GET':
+                context['polls'] += 1
+                if context['polls'] >= 2:
+                    for task in context['tasks']:
+                        name = task['layer']['name']
+                        task['state'] = server.final_states.get(name, 'COMPLETE')
+                        if task['state'] == 'COMPLETE':
+                            server.layers.add(name)
+                return self.reply(200, {'tasks': context['tasks']})
+            if method == 'PUT':
+                return self.reply(204)
+        self.reply(404, {})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+class ImporterServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, layers=None, final_states=None, stores=None):
+        """
+        :param layers: The names of the layers that already exist.
+        :param final_states: The state the tasks of each layer end in, if it isn't COMPLETE.
+        :param stores: The names of the datastores that already exist.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ImporterHandler)
+        self.layers = set(layers or [])
+        self.final_states = final_states or {}
+        self.stores = set(stores or [])
+        self.imports = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+
+def serve_importer(**kwargs):
+    """
+    :return: An ImporterServer on a free local port, running in a thread.
+    """
+    server = ImporterServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import datetime
+import itertools
+import threading
+import contextlib
+import cProfile
+
+
+class Instrumentation:
+    """
+    Times each stage of the pipeline and counts the bytes, rows and documents of every source. Stages can
+    be nested, each one is only charged for the time not spent in the stages inside it. Hooks are called as
+    hook(source, stage) when a stage starts and may return a context manager that is held for the stage.
+    """
+
+    def __init__(self, metrics_path=None):
+        """
+        :param metrics_path: A .prom file for the Prometheus textfile collector or a .json report, rewritten
+        after each run with the latest figures of every source.
+        """
+        self.metrics_path = metrics_path
+        self.hooks = []
+        self.stats = {}
+        self.latest = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add_hook(self, hook, stage=None):
+        """
+        :param hook: A callable taking the source and stage names, see ProfileHook.
+        :param stage: The only stage to call the hook for, or None for every stage.
+        """
+        self.hooks.append((stage, hook))
+
+    @contextlib.contextmanager
+    def stage(self, source, stage):
+        contexts = []
+        for hook_stage, hook in self.hooks:
+            if hook_stage is None or hook_stage == stage:
+                context = hook(source, stage)
+                if context is not None:
+                    context.__enter__()
+                    contexts.append(context)
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        # the first item collects the time of nested stages so it isn't counted twice.
+        frame = [0.0]
+        self.local.stack.append(frame)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.local.stack.pop()
+            if self.local.stack:
+                self.local.stack[-1][0] += elapsed
+            self.record(source, stage, elapsed - frame[0])
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+
+    def timed(self, iterable, source, stage, chunk_size=1000):
+        """
+        :param chunk_size: The number of items produced in each timed call, so the timing costs little per item.
+        :return: A generator of the items of iterable, the time spent producing them is charged to stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(source, stage):
+                chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+
+    def record(self, source, stage, seconds, calls=1):
+        with self.lock:
+            stages = self.stats.setdefault(source, {'stages': {}, 'counts': {}})['stages']
+            totals = stages.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['calls'] += calls
+
+    def count(self, source, name, amount=1):
+        with self.lock:
+            counts = self.stats.setdefault(source, {'stages': {}, 'counts': {}})['counts']
+            counts[name] = counts.get(name, 0) + amount
+
+    def finish(self, database=None, sources=None, kind='refresh', seconds=None):
+        """
+        Ends a run, the figures of its sources are saved to the run_history collection and exported.
+        :param database: The mongo database to save the run in.
+        :param sources: The names of the sources in the run, all of them if None.
+        :param kind: What started the run, like 'refresh', 'scheduled' or 'upload'.
+        :param seconds: How long the whole run took.
+        :return: The run as saved.
+        """
+        with self.lock:
+            if sources is None:
+                sources = self.stats.keys()
+            stats = dict((source, self.stats.pop(source)) for source in sources if source in self.stats)
+            self.latest.update(stats)
+            latest = dict(self.latest)
+        run = {'date': datetime.datetime.utcnow(),
+               'kind': kind,
+               'seconds': seconds,
+               'sources': [dict(import_name=source, **stats[source]) for source in sorted(stats)]}
+        if database is not None and stats:
+            database.run_history.insert_one(dict(run))
+        if self.metrics_path:
+            if self.metrics_path.lower().endswith('.json'):
+                write_json(self.metrics_path, latest)
+            else:
+                write_prometheus(self.metrics_path, latest)
+        for hook_stage, hook in self.hooks:
+            if hasattr(hook, 'finish'):
+                hook.finish(stats.keys())
+        return run
+
+
+class ProfileHook:
+    """
+    Profiles a stage with cProfile and writes <source>.<stage>.prof files to a directory when a run finishes,
+    for example instrumentation.add_hook(ProfileHook('./profiles'), stage='parse'). Profiles are kept per
+    source so only sources refreshed one at a time should be profiled.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, source, stage):
+        with self.lock:
+            profile = self.profiles.setdefault((source, stage), cProfile.Profile())
+        return ProfileContext(profile)
+
+    def finish(self, sources):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with self.lock:
+            for source, stage in list(self.profiles):
+                if source in sources:
+                    self.profiles.pop((source, stage)).dump_stats(
+                        os.path.join(self.directory, '{}.{}.prof'.format(source, stage)))
+
+
+class ProfileContext:
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        self.profile.enable()
+
+    def __exit__(self, *args):
+        self.profile.disable()
+
+
+def write_json(path, stats):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump({'date': '{:%Y-%m-%dT%H:%M:%S}'.format(datetime.datetime.utcnow()), 'sources': stats},
+                  json_file, indent=2, sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def write_prometheus(path, stats):
+    """
+    Writes the stats in the Prometheus text format, the file is replaced at once so the textfile collector
+    never reads a partial one.
+    """
+    lines = ['# HELP datawrangler_stage_seconds Seconds spent in each stage of the last run of a source.',
+             '# TYPE datawrangler_stage_seconds gauge']
+    for source in sorted(stats):
+        for stage, totals in sorted(stats[source]['stages'].items()):
+            lines.append('datawrangler_stage_seconds{{source="{}",stage="{}"}} {:.6f}'.format(
+                escape_label(source), escape_label(stage), totals['seconds']))
+    lines += ['# HELP datawrangler_stage_calls Times each stage was entered in the last run of a source.',
+              '# TYPE datawrangler_stage_calls gauge']
+    for source in sorted(stats):
+        for stage, totals in sorted(stats[source]['stages'].items()):
+            lines.append('datawrangler_stage_calls{{source="{}",stage="{}"}} {}'.format(
+                escape_label(source), escape_label(stage), totals['calls']))
+    names = sorted(set(name for source in stats for name in stats[source]['counts']))
+    for name in names:
+        lines += ['# HELP datawrangler_{} The {} handled in the last run of a source.'.format(name, name),
+                  '# TYPE datawrangler_{} gauge'.format(name)]
+        for source in sorted(stats):
+            if name in stats[source]['counts']:
+                lines.append('datawrangler_{}{{source="{}"}} {}'.format(
+                    name, escape_label(source), stats[source]['counts'][name]))
+    lines += ['# HELP datawrangler_last_run_timestamp_seconds When the metrics were last written.',
+              '# TYPE datawrangler_last_run_timestamp_seconds gauge',
+              'datawrangler_last_run_timestamp_seconds {:.0f}'.format(time.time())]
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as prom_file:
+        prom_file.write('\n'.join(lines) + '\n')
+    os.rename(temp_path, path)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
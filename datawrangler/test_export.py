@@ -0,0 +1,61 @@
+"""
+Tests how documents are written by exports. Run it from this folder:
+
+    python -m unittest test_export
+"""
+import json
+import unittest
+from cStringIO import StringIO
+from database import feature_parts, write_export
+
+POINT = {'type': 'Point', 'coordinates': [1.0, 2.0]}
+
+
+def export_lines(documents, format, **kwargs):
+    export_file = StringIO()
+    write_export(documents, export_file, format, **kwargs)
+    return export_file.getvalue().splitlines()
+
+
+class ExportTest(unittest.TestCase):
+
+    def test_feature(self):
+        document = {'type': 'Feature', 'geometry': POINT, 'properties': {'name': 'a'}, 'dw_bbox': [1, 2, 1, 2],
+                    'dw_centroid': POINT, 'dw_simplified_0_01': POINT}
+        self.assertEqual(feature_parts(document), ({'name': 'a'}, POINT, [1, 2, 1, 2]))
+
+    def test_geometry_text_is_a_property(self):
+        document = {'name': 'a', 'geometry': 'POINT (1 2)'}
+        self.assertEqual(feature_parts(document), ({'name': 'a', 'geometry': 'POINT (1 2)'}, None, None))
+        for format in ['ndjson', 'geojson']:
+            lines = export_lines([document], format)
+            feature = json.loads(lines[0] if format == 'ndjson' else '\n'.join(lines))
+            if format == 'geojson':
+                feature = feature['features'][0]
+                self.assertIsNone(feature['geometry'])
+                feature = feature['properties']
+            self.assertEqual(feature, {'name': 'a', 'geometry': 'POINT (1 2)'})
+
+    def test_properties_field_is_a_property(self):
+        document = {'name': 'a', 'properties': 'b', 'geometry': POINT}
+        feature = json.loads(export_lines([document], 'ndjson')[0])
+        self.assertEqual(feature, {'type': 'Feature', 'geometry': POINT,
+                                   'properties': {'name': 'a', 'properties': 'b'}})
+
+    def test_feature_properties_named_geometry(self):
+        document = {'type': 'Feature', 'geometry': POINT,
+                    'properties': {'geometry': 'POINT (1 2)', 'properties': 'b'}}
+        feature = json.loads(export_lines([document], 'ndjson')[0])
+        self.assertEqual(feature['geometry'], POINT)
+        self.assertEqual(feature['properties'], {'geometry': 'POINT (1 2)', 'properties': 'b'})
+        self.assertEqual(export_lines([document], 'csv'),
+                         ['geometry,properties,dw_geometry',
+                          'POINT (1 2),b,"{""type"": ""Point"", ""coordinates"": [1.0, 2.0]}"'])
+
+    def test_csv_geometry_column(self):
+        lines = export_lines([{'name': 'a', 'geometry': POINT}, {'name': 'b'}], 'csv')
+        self.assertEqual(lines, ['name,geometry', 'a,"{""type"": ""Point"", ""coordinates"": [1.0, 2.0]}"', 'b,'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""
+Tests the GeoServer importer client against a stub of the importer REST API. Run it from this folder:
+
+    python -m unittest test_geoserver
+"""
+import time
+import unittest
+from geoserver import GeoServer
+from geoserver_stub import serve_importer
+
+
+class GeoServerTest(unittest.TestCase):
+
+    def serve(self, **kwargs):
+        server = serve_importer(**kwargs)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client(self, server, **kwargs):
+        return GeoServer(host='127.0.0.1', port=server.server_address[1], workspace='sde', store='imports',
+                         username='admin', password='geoserver', poll_interval=0.01, **kwargs)
+
+    def test_upload(self):
+        server = self.serve()
+        results = self.client(server).upload(['/data/roads.json', '/data/rivers.json'])
+        self.assertEqual(sorted((result['layer'], result['state']) for result in results),
+                         [('rivers', 'COMPLETE'), ('roads', 'COMPLETE')])
+        self.assertEqual(server.layers, set(['roads', 'rivers']))
+
+    def test_store_is_created(self):
+        server = self.serve()
+        self.client(server).upload('/data/roads.json')
+        self.assertEqual(server.stores, set(['imports']))
+        self.client(self.serve(stores=['imports'])).upload('/data/roads.json')
+
+    def test_groups(self):
+        server = self.serve()
+        results = self.client(server, group_size=2).upload(['/data/' + str(i) + '.json' for i in range(5)])
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len(server.imports), 3)
+        self.assertTrue(all(result['state'] == 'COMPLETE' for result in results))
+
+    def test_attention_states_end_polling(self):
+        server = self.serve(final_states={'roads': 'PENDING', 'rivers': 'NO_CRS'})
+        started = time.time()
+        results = self.client(server, timeout=60).upload(['/data/roads.json', '/data/rivers.json'])
+        self.assertLess(time.time() - started, 10)
+        self.assertEqual(sorted((result['layer'], result['state']) for result in results),
+                         [('rivers', 'NO_CRS'), ('roads', 'PENDING')])
+
+    def test_existing_layers_are_imported_again(self):
+        server = self.serve(layers=['roads'])
+        results = self.client(server).upload('/data/roads.json')
+        self.assertEqual([result['state'] for result in results], ['COMPLETE'])
+        self.assertIn(('POST', 'imports'), server.requests)
+
+    def test_skip_existing(self):
+        server = self.serve(layers=['roads'])
+        results = self.client(server, skip_existing=True).upload(['/data/roads.json', '/data/rivers.json'])
+        self.assertEqual(sorted((result['layer'], result['state']) for result in results),
+                         [('rivers', 'COMPLETE'), ('roads', 'EXISTS')])
+        self.assertEqual(len(server.imports), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
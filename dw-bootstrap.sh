@@ -50,6 +50,7 @@ sudo yum install gdal-python -y
 sudo pip install pymongo
 sudo pip install requests
 sudo pip install xlrd 
+sudo pip install openpyxl
 sudo pip install unicodecsv
 
 